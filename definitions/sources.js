@@ -9,7 +9,11 @@
     "tiktok_videos",
     "tiktok_hashtags",
     "tiktok_media_urls",
+    "tiktok_posts",
+    "tiktok_post_hashtags",
     "payment_operations",
+    "payment_operations_rollup",
+    "managers",
     "promo_exp",
     "promo_expenses",
     "payment_operation",
@@ -0,0 +1,112 @@
+import uuid
+from google.cloud import bigquery
+
+# Replace the rows of a set of keys in a BigQuery table: the new rows are loaded
+# into a throwaway staging table (a load job, so nothing lands in the streaming
+# buffer), then one transaction deletes the old rows and inserts the new ones.
+# A key is one column, or a tuple of columns for tables with several rows per
+# record (e.g. ("isrc", "date")); its values are then given as key_of() strings.
+
+KEY_SEPARATOR = "\x1f"
+
+
+class StreamingBufferError(RuntimeError):
+    """The table still has streamed rows in its buffer, which DML can't modify yet."""
+
+
+def key_of(row: dict, key) -> str:
+    """The key value of a row, as compared by replace_by_key."""
+    if isinstance(key, str):
+        value = row.get(key)
+        return str(value) if value is not None else None
+    return KEY_SEPARATOR.join("" if row.get(k) is None else str(row.get(k)) for k in key)
+
+
+def key_sql(key) -> str:
+    """The SQL expression of a table's key, as compared by replace_by_key (the SQL side of key_of)."""
+    if isinstance(key, str):
+        return f"CAST(`{key}` AS STRING)"
+    columns = ", ".join(f"IFNULL(CAST(`{k}` AS STRING), '')" for k in key)
+    return f"ARRAY_TO_STRING([{columns}], '\\x1f')"
+
+
+def _replace(client: bigquery.Client, project_id: str, dataset_id: str, table_id: str,
+             key: str, keys, load_staging):
+    keys = sorted({str(k) for k in keys if k is not None})
+    if not keys:
+        return
+
+    target = client.get_table(client.dataset(dataset_id).table(table_id))
+    if target.streaming_buffer is not None:
+        # the DELETE would fail after the staging load; rows leave the buffer within ~90 minutes
+        raise StreamingBufferError(f"{project_id}.{dataset_id}.{table_id} has rows in its streaming buffer")
+    columns = ", ".join(f"`{f.name}`" for f in target.schema)
+    staging_id = f"{table_id}__staging_{uuid.uuid4().hex[:12]}"
+    staging_ref = client.dataset(dataset_id).table(staging_id)
+
+    has_rows = load_staging(staging_ref, target.schema)
+
+    sql = f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{project_id}.{dataset_id}.{table_id}`
+    WHERE {key_sql(key)} IN UNNEST(@keys);
+    """
+    if has_rows:
+        sql += f"""
+    INSERT INTO `{project_id}.{dataset_id}.{table_id}` ({columns})
+    SELECT {columns} FROM `{project_id}.{dataset_id}.{staging_id}`;
+    """
+    sql += "COMMIT TRANSACTION;"
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("keys", "STRING", keys)]
+    )
+    try:
+        client.query(sql, job_config=job_config).result()
+    finally:
+        if has_rows:
+            client.delete_table(staging_ref, not_found_ok=True)
+
+
+def replace_by_key(client: bigquery.Client, project_id: str, dataset_id: str, table_id: str,
+                   key: str, keys, rows):
+    """
+    Delete every row of `table_id` whose `key` column is in `keys`, then insert
+    `rows`. Keys are compared as strings (key_of for a tuple of columns). A key
+    with no rows is just deleted. Raises StreamingBufferError, before loading
+    anything, while the table has a streaming buffer.
+    """
+    def load_staging(staging_ref, schema):
+        if not rows:
+            return False
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        client.load_table_from_json(rows, staging_ref, job_config=job_config).result()
+        return True
+
+    _replace(client, project_id, dataset_id, table_id, key, keys, load_staging)
+    return len(rows)
+
+
+def replace_by_key_from_file(client: bigquery.Client, project_id: str, dataset_id: str,
+                             table_id: str, key: str, keys, f, row_count: int):
+    """
+    Same as replace_by_key, with the rows read from a newline-delimited JSON
+    file instead of memory.
+    """
+    def load_staging(staging_ref, schema):
+        if not row_count:
+            return False
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        f.seek(0)
+        client.load_table_from_file(f, staging_ref, job_config=job_config).result()
+        return True
+
+    _replace(client, project_id, dataset_id, table_id, key, keys, load_staging)
+    return row_count
@@ -0,0 +1,456 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import importlib
+import threading
+from datetime import datetime, timezone
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+import run_state
+import bq_upsert
+
+# Quarantine for records that can't be loaded: a record whose mapper raises, or
+# a row BigQuery rejects, is written with its raw source record and the reason
+# to a local NDJSON file (and, if BQ_DEAD_LETTER_TABLE is set, to that table),
+# and the run goes on. The run fails at the end if more than ETL_MAX_ERROR_RATE
+# of its rows were quarantined. An entry is kept once per (job, target table,
+# record key), so a bad record met again by the next run replaces its entry
+# instead of adding one. After a fix, `replay` loads the rows again, replacing
+# by key whatever the table already holds for them: a map failure's record is
+# re-mapped with the current code, an insert failure replays its rejected row.
+#
+#   python etl/dead_letter.py replay --job payment_operations [--source bigquery] [--dry-run]
+
+DEAD_LETTER_DIR = os.environ.get("ETL_DEAD_LETTER_DIR", ".etl_dead_letter")
+DEAD_LETTER_TABLE = os.environ.get("BQ_DEAD_LETTER_TABLE")  # "dataset.table", optional
+MAX_ERROR_RATE = float(os.environ.get("ETL_MAX_ERROR_RATE", "0.01"))
+MAX_INSERT_ATTEMPTS = 3
+# rows that were fine but not inserted because another row of the request
+# failed, and errors on BigQuery's side: both are worth another attempt
+RETRY_REASONS = {"stopped", "backendError", "internalError", "timeout", "rateLimitExceeded"}
+
+SCHEMA = [
+    bigquery.SchemaField("id", "STRING"),
+    bigquery.SchemaField("job", "STRING"),
+    bigquery.SchemaField("quarantined_at", "TIMESTAMP"),
+    bigquery.SchemaField("stage", "STRING"),  # "map", "validate" or "insert"
+    bigquery.SchemaField("target_table", "STRING"),  # dataset.table
+    bigquery.SchemaField("mapper", "STRING"),  # module:function
+    bigquery.SchemaField("reason", "STRING"),
+    bigquery.SchemaField("record", "STRING"),  # raw source record, JSON
+    bigquery.SchemaField("row", "STRING"),  # rejected row, JSON
+    bigquery.SchemaField("key", "STRING"),  # key column(s) of target_table, comma-separated
+    bigquery.SchemaField("record_key", "STRING"),  # key of the record, or of the rejected row
+]
+
+
+def get_bq_client() -> bigquery.Client:
+    project_id = os.environ["GCP_PROJECT_ID"]
+    sa_key_json = os.environ["GCP_SERVICE_ACCOUNT_KEY"]
+    info = json.loads(sa_key_json)
+    credentials = service_account.Credentials.from_service_account_info(info)
+    return bigquery.Client(project=project_id, credentials=credentials)
+
+
+def mapper_name(mapper) -> str:
+    """module:function, with the script's own name when it runs as __main__."""
+    module = mapper.__module__
+    if module in ("__main__", "__mp_main__"):
+        module = os.path.splitext(os.path.basename(sys.modules[module].__file__))[0]
+    return f"{module}:{mapper.__qualname__}"
+
+
+def load_mapper(name: str):
+    module, func = name.split(":")
+    return getattr(importlib.import_module(module), func)
+
+
+def apply(mapper, record):
+    """Rows of one record; a mapper returns either one row or a list of rows."""
+    result = mapper(record)
+    return result if isinstance(result, list) else [result]
+
+
+def table_name(table_ref) -> str:
+    return f"{table_ref.dataset_id}.{table_ref.table_id}"
+
+
+def entry_id(job: str, target_table: str, record_key: str) -> str:
+    return hashlib.sha256(f"{job}\0{target_table}\0{record_key}".encode("utf-8")).hexdigest()[:32]
+
+
+def key_columns(key: str):
+    """A key as stored in an entry, back to a column or tuple of columns."""
+    columns = tuple(key.split(","))
+    return columns[0] if len(columns) == 1 else columns
+
+
+_INT = re.compile(r"[+-]?\d+")
+_DATE = re.compile(r"\d{4}-\d{1,2}-\d{1,2}")
+
+
+def _valid(field_type: str, value) -> bool:
+    if field_type in ("INTEGER", "INT64"):
+        if isinstance(value, str):
+            value = int(value.strip()) if _INT.fullmatch(value.strip()) else None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return isinstance(value, int) and not isinstance(value, bool) and -2**63 <= value < 2**63
+    if field_type in ("FLOAT", "FLOAT64", "NUMERIC", "BIGNUMERIC"):
+        if isinstance(value, str):
+            try:
+                float(value)
+                return True
+            except ValueError:
+                return False
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if field_type in ("BOOLEAN", "BOOL"):
+        return isinstance(value, bool) or str(value).lower() in ("true", "false", "1", "0")
+    if field_type == "DATE":
+        return isinstance(value, str) and bool(_DATE.fullmatch(value.strip()))
+    if field_type in ("TIMESTAMP", "DATETIME"):
+        # the formats BigQuery takes are many; a date in front is what they share
+        return isinstance(value, (int, float)) and not isinstance(value, bool) or (
+            isinstance(value, str) and bool(_DATE.match(value.strip()))
+        )
+    if field_type == "STRING":
+        return not isinstance(value, (dict, list))
+    return True
+
+
+def row_errors(row: dict, schema) -> list:
+    """Why a load job would reject row under schema; empty if the row fits."""
+    fields = {f.name: f for f in schema}
+    errors = [f"no such field: {name}" for name in row if name not in fields]
+    for field in schema:
+        value = row.get(field.name)
+        if value is None:
+            if field.mode == "REQUIRED":
+                errors.append(f"{field.name}: missing required value")
+            continue
+        if field.mode == "REPEATED" and not isinstance(value, list):
+            errors.append(f"{field.name}: expected an array")
+            continue
+        for v in value if field.mode == "REPEATED" else [value]:
+            if field.field_type in ("RECORD", "STRUCT"):
+                nested = row_errors(v, field.fields) if isinstance(v, dict) else ["expected an object"]
+                errors.extend(f"{field.name}.{e}" for e in nested)
+            elif v is not None and not _valid(field.field_type, v):
+                errors.append(f"{field.name}: invalid {field.field_type} value {str(v)[:100]!r}")
+    return errors
+
+
+def by_key(load_records, key: str, row_key: str = None):
+    """
+    Row -> source record lookup, matching row[row_key] (default: key) to
+    record[key]. load_records is only called once a row is rejected, so a page
+    kept as raw bytes is decoded only when needed.
+    """
+    index = {}
+
+    def source_of(row):
+        if not index:
+            index.update((str(r.get(key)), r) for r in load_records())
+        return index.get(str(row.get(row_key or key)))
+    return source_of
+
+
+class DeadLetter:
+    """
+    Quarantine of one job. Given the run_state run, the error-rate counters
+    travel in its checkpoint, so a run split over several deadlines is judged
+    as a whole. keys maps a target table ("dataset.table") to its key, a
+    column or tuple of columns that tells its rows apart, and the record's key
+    field (or a function of the record) for records that fail to map; replay
+    needs the key of a table.
+    """
+
+    def __init__(self, job: str, client: bigquery.Client = None, project_id: str = None, run: dict = None,
+                 keys: dict = None):
+        self.job = job
+        self.keys = dict(keys or {})
+        self.client = client
+        self.project_id = project_id
+        self.run = run
+        self.lock = threading.Lock()
+        self.pending = []  # entries not yet written to BQ_DEAD_LETTER_TABLE
+        # rows handed to insert plus records that failed to map, and how many were quarantined
+        counts = {"rows": 0, "rejected": 0}
+        self.counts = run.setdefault("dead_letter", counts) if run is not None else counts
+
+    def _record_key(self, target_table: str, record, row):
+        key, record_key = self.keys.get(target_table, (None, None))
+        try:
+            if row is not None and key is not None:
+                return bq_upsert.key_of(row, key)
+            if record_key is not None:
+                value = record.get(record_key) if isinstance(record_key, str) else record_key(record)
+                return str(value) if value is not None else None
+        except Exception:
+            pass  # e.g. a record too broken to have a key
+        return None
+
+    def quarantine(self, stage: str, target_table: str, mapper: str, record, reason: str, row=None):
+        key = self.keys.get(target_table, (None, None))[0]
+        record_key = self._record_key(target_table, record, row)
+        record_json = json.dumps(record, default=str)
+        entry = {
+            # without a key the record itself tells repeats apart
+            "id": entry_id(self.job, target_table, record_key if record_key is not None else record_json),
+            "job": self.job,
+            "quarantined_at": datetime.now(timezone.utc).isoformat(),
+            "stage": stage,
+            "target_table": target_table,
+            "mapper": mapper,
+            "reason": reason,
+            "record": record_json,
+            "row": json.dumps(row, default=str) if row is not None else None,
+            "key": key if key is None or isinstance(key, str) else ",".join(key),
+            "record_key": record_key,
+        }
+        print(f"Quarantined {stage} failure for {target_table}: {reason[:300]}")
+        with self.lock:
+            self.counts["rejected"] += 1
+            self.pending.append(entry)
+            os.makedirs(DEAD_LETTER_DIR, exist_ok=True)
+            with open(os.path.join(DEAD_LETTER_DIR, f"{self.job}.ndjson"), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def map(self, table_ref, mapper, records):
+        """Rows of mapper applied to each record; a record whose mapper raises is quarantined."""
+        rows = []
+        for record in records:
+            try:
+                rows.extend(apply(mapper, record))
+            except Exception as e:
+                self.counts["rows"] += 1
+                self.quarantine("map", table_name(table_ref), mapper_name(mapper), record, repr(e))
+        return rows
+
+    def count(self, rows: int):
+        """Count rows loaded without insert (e.g. spooled for a load job) towards the error rate."""
+        self.counts["rows"] += rows
+
+    def map_failures(self, failures):
+        """Quarantine (target_table, mapper name, record, reason) tuples collected in a worker."""
+        for target_table, mapper, record, reason in failures:
+            self.counts["rows"] += 1
+            self.quarantine("map", target_table, mapper, record, reason)
+
+    def validate(self, table_ref, schema, rows, mapper, source_of):
+        """
+        Rows that fit schema. The others are quarantined with source_of(row)
+        before they reach a load job, where a single one would fail the load.
+        The rows are expected to be counted already (see count).
+        """
+        valid = []
+        for row in rows:
+            errors = row_errors(row, schema)
+            if errors:
+                self.quarantine(
+                    "validate", table_name(table_ref), mapper_name(mapper),
+                    source_of(row), "; ".join(errors), row,
+                )
+            else:
+                valid.append(row)
+        return valid
+
+    def insert(self, table_ref, rows, mapper, source_of, into=None):
+        """
+        insert_rows_json with per-row error handling: rejected rows are
+        quarantined with source_of(row), the rest of the batch is retried.
+        Rows go to `into` (a full load's staging table) if given; they are
+        quarantined under table_ref either way. Returns the rows that were
+        inserted.
+        """
+        self.counts["rows"] += len(rows)
+        pending = list(rows)
+        inserted = []
+        for attempt in range(1, MAX_INSERT_ATTEMPTS + 1):
+            if not pending:
+                break
+            errors = self.client.insert_rows_json(into or table_ref, pending)
+            failed = {e["index"]: e["errors"] for e in errors}
+            inserted.extend(row for i, row in enumerate(pending) if i not in failed)
+
+            retry, transient = [], False
+            for i, row_errors in failed.items():
+                reasons = {err.get("reason") for err in row_errors}
+                if reasons <= RETRY_REASONS and attempt < MAX_INSERT_ATTEMPTS:
+                    retry.append(pending[i])
+                    transient = transient or reasons != {"stopped"}
+                else:
+                    self.quarantine(
+                        "insert", table_name(table_ref), mapper_name(mapper),
+                        source_of(pending[i]), json.dumps(row_errors), pending[i],
+                    )
+            if transient:
+                time.sleep(attempt)
+            pending = retry
+        return inserted
+
+    def flush(self):
+        """
+        Compact the local file to one entry per id, then write the entries of
+        this run to BQ_DEAD_LETTER_TABLE, if configured, replacing earlier
+        entries with the same id.
+        """
+        with self.lock:
+            entries, self.pending = self.pending, []
+            if entries:
+                write_local(self.job, read_local(self.job))
+        if not entries or not DEAD_LETTER_TABLE or self.client is None:
+            return
+        entries = list({e["id"]: e for e in entries}.values())
+        dataset_id, table_id = DEAD_LETTER_TABLE.split(".")
+        table = bigquery.Table(self.client.dataset(dataset_id).table(table_id), schema=SCHEMA)
+        table = self.client.create_table(table, exists_ok=True)
+        missing = [f for f in SCHEMA if f.name not in {c.name for c in table.schema}]
+        if missing:
+            # a table created before entries had keys
+            table.schema = list(table.schema) + missing
+            self.client.update_table(table, ["schema"])
+        # a load job and DML, not streaming: replay deletes what it re-loaded
+        bq_upsert.replace_by_key(
+            self.client, self.project_id, dataset_id, table_id, "id", [e["id"] for e in entries], entries,
+        )
+        print(f"Wrote {len(entries)} dead-letter entries to {self.project_id}.{DEAD_LETTER_TABLE}")
+
+    def finish(self):
+        """Flush, then fail the run if too many of its rows were quarantined."""
+        self.flush()
+        rows, rejected = self.counts["rows"], self.counts["rejected"]
+        if not rejected:
+            return
+        rate = rejected / max(rows, 1)
+        print(f"Quarantined {rejected} of {rows} rows ({rate:.2%}) for {self.job}")
+        if rate > MAX_ERROR_RATE:
+            if self.run is not None:
+                run_state.abandon(self.job)
+            raise RuntimeError(
+                f"{self.job}: {rate:.2%} of rows quarantined, above ETL_MAX_ERROR_RATE={MAX_ERROR_RATE:.2%}"
+            )
+
+
+def read_local(job: str):
+    """Entries of a job, the last one of each id."""
+    path = os.path.join(DEAD_LETTER_DIR, f"{job}.ndjson")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        entries = (json.loads(line) for line in f if line.strip())
+        return list({e["id"]: e for e in entries}.values())
+
+
+def write_local(job: str, entries):
+    path = os.path.join(DEAD_LETTER_DIR, f"{job}.ndjson")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp, path)
+
+
+def read_bigquery(client: bigquery.Client, project_id: str, job: str):
+    sql = f"SELECT * FROM `{project_id}.{DEAD_LETTER_TABLE}` WHERE job = @job ORDER BY quarantined_at"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("job", "STRING", job)]
+    )
+    return [
+        dict(r.items(), quarantined_at=r["quarantined_at"].isoformat())
+        for r in client.query(sql, job_config=job_config).result()
+    ]
+
+
+def replay(args):
+    """
+    Load the rows of quarantined entries into their target tables, replacing
+    the rows already there under the same keys (a staging load and DML, so
+    nothing lands in the streaming buffer and a replay is never doubled). A
+    record that failed to map or validate is re-mapped with the current mapper;
+    an insert failure replays only its rejected row. Entries that still fail
+    stay quarantined, as do the entries of a table that still has a streaming
+    buffer.
+    """
+    client = None if args.dry_run and args.source == "local" else get_bq_client()
+    project_id = os.environ.get("GCP_PROJECT_ID")
+    if args.source == "bigquery":
+        if not DEAD_LETTER_TABLE:
+            raise SystemExit("BQ_DEAD_LETTER_TABLE is not set")
+        entries = read_bigquery(client, project_id, args.job)
+    else:
+        entries = read_local(args.job)
+    print(f"{len(entries)} quarantined entries for {args.job}")
+
+    # target table -> (key, {key value: rows}, entry ids); a later entry's rows
+    # of a key replace an earlier one's
+    by_table = {}
+    for entry in entries:
+        if not entry.get("key"):
+            print(f"No key for {entry['target_table']} on entry {entry['id']}, kept")
+            continue
+        key = key_columns(entry["key"])
+        if entry["stage"] == "insert" and entry.get("row"):
+            rows = [json.loads(entry["row"])]
+        else:
+            try:
+                rows = apply(load_mapper(entry["mapper"]), json.loads(entry["record"]))
+            except Exception as e:
+                print(f"Still failing: {entry['mapper']} on entry {entry['id']}: {e!r}")
+                continue
+        _, table_rows, ids = by_table.setdefault(entry["target_table"], (key, {}, []))
+        entry_rows = {}
+        for row in rows:
+            entry_rows.setdefault(bq_upsert.key_of(row, key), []).append(row)
+        table_rows.update(entry_rows)
+        ids.append(entry["id"])
+
+    replayed = set()
+    for target_table, (key, table_rows, ids) in by_table.items():
+        rows = [row for key_rows in table_rows.values() for row in key_rows]
+        if args.dry_run:
+            print(f"[dry-run] {target_table}: {len(rows)} rows under {len(table_rows)} keys from {len(ids)} entries")
+            continue
+        dataset_id, table_id = target_table.split(".")
+        try:
+            bq_upsert.replace_by_key(client, project_id, dataset_id, table_id, key, table_rows.keys(), rows)
+        except bq_upsert.StreamingBufferError as e:
+            print(f"{e}, entries kept: replay again once it has drained")
+            continue
+        except Exception as e:
+            print(f"Replace in {target_table} failed, entries kept: {e}")
+            continue
+        replayed.update(ids)
+        print(f"Replayed {len(rows)} rows from {len(ids)} entries into {project_id}.{target_table}")
+
+    if args.dry_run or not replayed:
+        return
+    if args.source == "bigquery":
+        sql = f"DELETE FROM `{project_id}.{DEAD_LETTER_TABLE}` WHERE id IN UNNEST(@ids)"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", sorted(replayed))]
+        )
+        client.query(sql, job_config=job_config).result()
+    else:
+        write_local(args.job, [e for e in entries if e["id"] not in replayed])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dead-letter quarantine for ETL rows")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="re-map and load quarantined records")
+    replay_parser.add_argument("--job", required=True, help="JOB_NAME of the script, e.g. payment_operations")
+    replay_parser.add_argument("--source", choices=["local", "bigquery"], default="local",
+                               help="read entries from ETL_DEAD_LETTER_DIR or BQ_DEAD_LETTER_TABLE")
+    replay_parser.add_argument("--dry-run", action="store_true", help="re-map only, load nothing")
+    args = parser.parse_args()
+    replay(args)
+
+
+if __name__ == "__main__":
+    main()
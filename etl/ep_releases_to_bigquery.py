@@ -1,11 +1,22 @@
 import os
 import json
-import requests
+import itertools
+import tempfile
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import bq_upsert
+import dead_letter
+import full_load
+import page_cache
+import parallel_transform
+import rate_limiter
+import run_state
+import sharding
+
 API_BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin"
 LIMIT = 500  # adjust if needed
+JOB_NAME = "ep_releases"
 
 
 def get_bq_client() -> bigquery.Client:
@@ -16,19 +27,34 @@ def get_bq_client() -> bigquery.Client:
     return bigquery.Client(project=project_id, credentials=credentials)
 
 
-def fetch_page(api_key: str, offset: int):
+def fetch_page_response(api_key: str, offset: int, conditional: dict = None):
     url = f"{API_BASE_URL}/promo-releases"
     params = {"limit": LIMIT, "offset": offset}
     headers = {
         "X-Admin-Api-Key": api_key,
         "Accept": "application/json",
+        **(conditional or {}),
     }
-    resp = requests.get(url, params=params, headers=headers, timeout=60)
+    resp = rate_limiter.get(url, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
-    data = resp.json()
-    return data.get("data", [])
+    return resp
+
+
+def fetch_page_raw(api_key: str, offset: int, cache: page_cache.PageCache = None) -> bytes:
+    resp = fetch_page_response(api_key, offset)
+    if cache is not None:
+        cache.record(offset, resp)
+    return resp.content
+
+
+def parse_page(raw: bytes):
+    return json.loads(raw).get("data", [])
+
+
+def fetch_page(api_key: str, offset: int):
+    return parse_page(fetch_page_raw(api_key, offset))
 
 
 def flatten_release_snapshot(rel):
@@ -112,80 +138,313 @@ def flatten_release_timeseries(rel):
     return rows
 
 
-def main():
-    project_id = os.environ["GCP_PROJECT_ID"]
+def table_ids():
+    return {
+        # snapshot table
+        "snap": (
+            os.environ.get("BQ_EP_SNAP_DATASET_ID", "raw_tiktok"),
+            os.environ.get("BQ_EP_SNAP_TABLE_ID", "ep_release"),
+        ),
+        # timeseries table
+        "ts": (
+            os.environ.get("BQ_EP_TS_DATASET_ID", "raw_tiktok"),
+            os.environ.get("BQ_EP_TS_TABLE_ID", "ep_timeseries"),
+        ),
+    }
 
-    # snapshot table
-    snap_dataset_id = os.environ.get("BQ_EP_SNAP_DATASET_ID", "raw_tiktok")
-    snap_table_id = os.environ.get("BQ_EP_SNAP_TABLE_ID", "ep_release")
 
-    # timeseries table
-    ts_dataset_id = os.environ.get("BQ_EP_TS_DATASET_ID", "raw_tiktok")
-    ts_table_id = os.environ.get("BQ_EP_TS_TABLE_ID", "ep_timeseries")
+# table -> mapper producing its rows from one release
+MAPPERS = {
+    "snap": flatten_release_snapshot,
+    "ts": flatten_release_timeseries,
+}
 
-    api_key = os.environ["API_KEY"]
+# table -> (key of its rows, release field), for the dead-letter quarantine
+KEYS = {
+    "snap": ("id", "id"),
+    "ts": (("release_id", "date"), "id"),
+}
+
+
+def dead_letter_keys():
+    tables = table_ids()
+    return {".".join(tables[name]): key for name, key in KEYS.items()}
+
+
+def flatten_page(releases):
+    """
+    Rows for both tables from one page of promo-releases:
+    ({"snap": [...], "ts": [...]}, failures)
+    A release whose mapper raises is left out of that table and reported in
+    failures as (table, mapper, release, reason) for the dead-letter quarantine.
+    """
+    tables = table_ids()
+    page_rows = {name: [] for name in MAPPERS}
+    failures = []
+    for rel in releases:
+        if rel.get("id") is None:
+            continue
+
+        for name, mapper in MAPPERS.items():
+            try:
+                page_rows[name].extend(dead_letter.apply(mapper, rel))
+            except Exception as e:
+                failures.append((".".join(tables[name]), dead_letter.mapper_name(mapper), rel, repr(e)))
+    return page_rows, failures
+
+
+def transform_raw_page(raw: bytes):
+    """
+    Worker-side transform for the process pool: decode one raw page and
+    return (item_count, {table: columns}, failures).
+    """
+    releases = parse_page(raw)
+    page_rows, failures = flatten_page(releases)
+    columns = {name: parallel_transform.to_columns(rows) for name, rows in page_rows.items()}
+    return len(releases), columns, failures
 
-    client = get_bq_client()
-    snap_table_ref = client.dataset(snap_dataset_id).table(snap_table_id)
-    ts_table_ref = client.dataset(ts_dataset_id).table(ts_table_id)
 
-    # *** Overwrite: clear tables before inserting this run ***
-    truncate_snap_sql = f"TRUNCATE TABLE `{project_id}.{snap_dataset_id}.{snap_table_id}`"
-    truncate_ts_sql = f"TRUNCATE TABLE `{project_id}.{ts_dataset_id}.{ts_table_id}`"
+def iter_pages(api_key: str, offsets, workers: int, cache: page_cache.PageCache = None):
+    """
+    Yield (offset, raw, item_count, page_rows, failures) in offset order until
+    the first empty page, raw being the page body in both the serial and the
+    pool mode. Fetched pages are recorded in cache, if given.
+    """
+    if not workers:
+        for offset in offsets:
+            raw = fetch_page_raw(api_key, offset, cache)
+            releases = parse_page(raw)
+            if not releases:
+                return
+            yield (offset, raw, len(releases), *flatten_page(releases))
+        return
+
+    pages = parallel_transform.imap_pages(
+        lambda offset: fetch_page_raw(api_key, offset, cache), transform_raw_page, offsets, workers
+    )
+    for offset, raw, (item_count, columns, failures) in pages:
+        page_rows = {name: parallel_transform.from_columns(c) for name, c in columns.items()}
+        yield offset, raw, item_count, page_rows, failures
 
-    print(f"Running: {truncate_snap_sql}")
-    client.query(truncate_snap_sql).result()
-    print("Snapshot table truncated before load")
 
-    print(f"Running: {truncate_ts_sql}")
-    client.query(truncate_ts_sql).result()
-    print("Timeseries table truncated before load")
+def page_release_ids(page_rows):
+    """Release ids a page contributed rows for, in either table."""
+    return [r["id"] for r in page_rows["snap"]] + [r["release_id"] for r in page_rows["ts"]]
 
-    offset = 0
-    total_snap_rows = 0
-    total_ts_rows = 0
 
-    while True:
-        releases = fetch_page(api_key, offset)
+def load_changed_pages(client: bigquery.Client, project_id: str, api_key: str,
+                       cache: page_cache.PageCache, dlq: dead_letter.DeadLetter, run: dict):
+    """
+    Incremental run against the page cache of the last load: only pages that
+    changed are decoded, and the rows of their releases are replaced in both
+    tables. Releases of vanished pages are deleted; nothing is written if no
+    page changed. Returns False, without fetching anything, while a table has
+    a streaming buffer: the caller then reloads them in full.
+    """
+    tables = table_ids()
+    keys = {"snap": "id", "ts": "release_id"}
+    refs = {
+        name: client.dataset(dataset_id).table(table_id)
+        for name, (dataset_id, table_id) in tables.items()
+    }
+    targets = {name: client.get_table(ref) for name, ref in refs.items()}
+    buffered = [
+        f"{project_id}.{t.dataset_id}.{t.table_id}" for t in targets.values() if t.streaming_buffer is not None
+    ]
+    if buffered:
+        print(f"{', '.join(buffered)} have rows in their streaming buffer, loading the EP tables in full")
+        return False
+    schemas = {name: t.schema for name, t in targets.items()}
+    files = {name: tempfile.NamedTemporaryFile("w+b", suffix=".ndjson") for name in tables}
+    totals = {name: 0 for name in tables}
+
+    for offset in itertools.count(0, LIMIT):
+        resp = fetch_page_response(api_key, offset, cache.validators(offset))
+        if cache.unchanged(offset, resp):
+            continue
+        releases = parse_page(resp.content)
         if not releases:
             break
 
-        snap_rows_to_insert = []
-        ts_rows_to_insert = []
+        page_rows, failures = flatten_page(releases)
+        dlq.map_failures(failures)
+        ids = page_release_ids(page_rows)
+        complete = not failures
+        for name, rows in page_rows.items():
+            dlq.count(len(rows))
+            # a row the staging load would reject is quarantined instead of failing the load
+            valid = dlq.validate(
+                refs[name], schemas[name], rows, MAPPERS[name],
+                dead_letter.by_key(lambda: releases, "id", row_key=keys[name]),
+            )
+            complete = complete and len(valid) == len(rows)
+            for row in valid:
+                files[name].write(json.dumps(row).encode("utf-8") + b"\n")
+            totals[name] += len(valid)
+        cache.page_loaded(offset, ids, complete=complete)
+        print(f"Changed page at offset={offset}, releases={len(releases)}")
+
+    if cache.all_unchanged():
+        print("No page changed, keeping the EP tables as is")
+    else:
+        stale = cache.stale_keys()
+        try:
+            for name, (dataset_id, table_id) in tables.items():
+                bq_upsert.replace_by_key_from_file(
+                    client, project_id, dataset_id, table_id, keys[name], stale, files[name], totals[name]
+                )
+                print(f"Replaced {totals[name]} changed rows in {project_id}.{dataset_id}.{table_id}")
+        except Exception:
+            # the tables may no longer match the cache: reload them in full next run
+            cache.clear()
+            raise
+    for f in files.values():
+        f.close()
+
+    cache.save()
+    run["rows"] = cache.row_count()
+    run["digest"] = cache.digest()
+    return True
+
+
+def run_full(workers: int = 0):
+    project_id = os.environ["GCP_PROJECT_ID"]
+    tables = table_ids()
+    snap_dataset_id, snap_table_id = tables["snap"]
+    ts_dataset_id, ts_table_id = tables["ts"]
 
-        for rel in releases:
-            if rel.get("id") is None:
-                continue
+    api_key = os.environ["API_KEY"]
+
+    client = get_bq_client()
+    snap_table_ref = client.dataset(snap_dataset_id).table(snap_table_id)
+    ts_table_ref = client.dataset(ts_dataset_id).table(ts_table_id)
 
-            snap_rows_to_insert.append(flatten_release_snapshot(rel))
-            ts_rows_to_insert.extend(flatten_release_timeseries(rel))
+    run = run_state.begin(JOB_NAME)
+    cache = page_cache.PageCache(JOB_NAME)
+    if cache.primed and not run["resumed"]:
+        dlq = dead_letter.DeadLetter(JOB_NAME, client, project_id, run, keys=dead_letter_keys())
+        if load_changed_pages(client, project_id, api_key, cache, dlq, run):
+            dlq.finish()
+            run_state.finish(JOB_NAME, run)
+            return
+
+    if not run["resumed"]:
+        # the cache describes the tables as this load leaves them, once published
+        cache.clear()
+
+    dlq = dead_letter.DeadLetter(JOB_NAME, client, project_id, run, keys=dead_letter_keys())
+    # *** Overwrite: the run fills staging tables, published over the tables at the end ***
+    snap_staging_ref = full_load.staging_table(client, run, snap_table_ref)
+    ts_staging_ref = full_load.staging_table(client, run, ts_table_ref)
+    # the full load rebuilds the page cache as it goes
+    cache.track(run)
+
+    offset = run["offset"]
+    # the totals travel in the checkpoint so a resumed run reports the whole load
+    totals = run.setdefault("totals", {"snap": 0, "ts": 0})
+
+    offsets = itertools.count(offset, LIMIT)
+    for offset, raw, item_count, page_rows, failures in iter_pages(api_key, offsets, workers, cache):
+        complete = not failures
+        dlq.map_failures(failures)
+        # rejected rows are traced back to their release only if there are any
+        snap_source_of = dead_letter.by_key(lambda: parse_page(raw), "id")
+        ts_source_of = dead_letter.by_key(lambda: parse_page(raw), "id", row_key="release_id")
+
+        snap_rows_to_insert = page_rows["snap"]
+        ts_rows_to_insert = page_rows["ts"]
 
         if snap_rows_to_insert:
-            snap_errors = client.insert_rows_json(snap_table_ref, snap_rows_to_insert)
-            if snap_errors:
-                raise RuntimeError(f"BigQuery EP snapshot insert errors: {snap_errors}")
-            batch_snap = len(snap_rows_to_insert)
-            total_snap_rows += batch_snap
+            inserted = dlq.insert(
+                snap_table_ref, snap_rows_to_insert, flatten_release_snapshot, snap_source_of, into=snap_staging_ref
+            )
+            batch_snap = len(inserted)
+            complete = complete and batch_snap == len(snap_rows_to_insert)
+            totals["snap"] += batch_snap
             print(f"Inserted EP snapshot batch at offset={offset}, rows={batch_snap}")
 
         if ts_rows_to_insert:
-            ts_errors = client.insert_rows_json(ts_table_ref, ts_rows_to_insert)
-            if ts_errors:
-                raise RuntimeError(f"BigQuery EP timeseries insert errors: {ts_errors}")
-            batch_ts = len(ts_rows_to_insert)
-            total_ts_rows += batch_ts
+            inserted = dlq.insert(
+                ts_table_ref, ts_rows_to_insert, flatten_release_timeseries, ts_source_of, into=ts_staging_ref
+            )
+            batch_ts = len(inserted)
+            complete = complete and batch_ts == len(ts_rows_to_insert)
+            totals["ts"] += batch_ts
             print(f"Inserted EP timeseries batch at offset={offset}, rows={batch_ts}")
 
-        offset += LIMIT
+        cache.page_loaded(offset, page_release_ids(page_rows), complete)
+        if run_state.page_done(JOB_NAME, run, offset + LIMIT, raw, item_count):
+            dlq.flush()
+            return
 
     print(
-        f"Inserted total {total_snap_rows} rows into "
+        f"Inserted total {totals['snap']} rows into "
         f"{project_id}.{snap_dataset_id}.{snap_table_id}"
     )
     print(
-        f"Inserted total {total_ts_rows} rows into "
+        f"Inserted total {totals['ts']} rows into "
         f"{project_id}.{ts_dataset_id}.{ts_table_id}"
     )
+    dlq.finish()
+    full_load.publish(client, project_id, snap_table_ref, snap_staging_ref)
+    full_load.publish(client, project_id, ts_table_ref, ts_staging_ref)
+    cache.save()
+    run["digest"] = cache.digest()
+    run_state.finish(JOB_NAME, run)
+
+
+def run_shard(shard_index: int, shard_count: int, workers: int = 0):
+    api_key = os.environ["API_KEY"]
+    client = get_bq_client()
+    tables = table_ids()
+
+    dlq = dead_letter.DeadLetter(JOB_NAME, client, os.environ.get("GCP_PROJECT_ID"), keys=dead_letter_keys())
+
+    files = {name: sharding.open_shard_file() for name in tables}
+    totals = {name: 0 for name in tables}
+    last_page = -1
+
+    offsets = sharding.shard_offsets(shard_index, shard_count, LIMIT)
+    for offset, _, _, page_rows, failures in iter_pages(api_key, offsets, workers):
+        last_page = offset // LIMIT
+        dlq.map_failures(failures)
+
+        for name, rows in page_rows.items():
+            sharding.write_rows(files[name], rows)
+            totals[name] += len(rows)
+            dlq.count(len(rows))
+
+    # the page after this shard's last one in its stride came back empty
+    empty_page = last_page + shard_count if last_page >= 0 else shard_index
+    # a shard over the error rate fails here, so the merge never sees it
+    dlq.finish()
+
+    for name, (dataset_id, table_id) in tables.items():
+        sharding.load_shard(
+            client, dataset_id, table_id, shard_index, shard_count,
+            files[name], totals[name], last_page, empty_page,
+        )
+        files[name].close()
+
+
+def run_merge(shard_count: int):
+    project_id = os.environ["GCP_PROJECT_ID"]
+    client = get_bq_client()
+    for dataset_id, table_id in table_ids().values():
+        sharding.merge_shards(client, project_id, dataset_id, table_id, shard_count)
+
+
+def main():
+    args = sharding.parse_args("Load promo releases from /promo-releases into BigQuery")
+    if args.local_shards:
+        sharding.run_local(run_shard, args.local_shards, args.transform_workers)
+        run_merge(args.local_shards)
+    elif args.shard_index is not None:
+        run_shard(args.shard_index, args.shard_count, args.transform_workers)
+    elif args.merge:
+        run_merge(args.shard_count)
+    else:
+        run_full(args.transform_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+
+# Full reloads that only show once they are complete. A run streams its pages
+# into a staging table of its own; a run that yields at its deadline resumes
+# into the same table from its checkpoint. Only a finished run replaces the
+# target, with one query job per table (like sharding.merge_shards), so until
+# then readers see the previous complete load. The target never holds
+# streamed rows either, so DML on it (bq_upsert, dead-letter replay, the
+# incremental page-cache runs, ingest_service.py) is not blocked by a
+# streaming buffer.
+
+STAGING_SUFFIX = "__full_"
+# staging tables of runs that were abandoned or discarded go away by themselves
+STAGING_EXPIRY = timedelta(days=2)
+
+
+def staging_table(client: bigquery.Client, run: dict, table_ref):
+    """
+    The staging table of this run for table_ref, created empty with the
+    target's schema on the first run and the same table when the run resumes.
+    """
+    token = run.setdefault("staging", uuid.uuid4().hex[:12])
+    target = client.get_table(table_ref)
+    ref = client.dataset(table_ref.dataset_id).table(f"{table_ref.table_id}{STAGING_SUFFIX}{token}")
+    table = client.create_table(bigquery.Table(ref, schema=target.schema), exists_ok=True)
+    table.expires = datetime.now(timezone.utc) + STAGING_EXPIRY
+    client.update_table(table, ["expires"])
+    return table.reference
+
+
+def publish(client: bigquery.Client, project_id: str, table_ref, staging_ref):
+    """Replace the target with the staging table in one query job, then drop the staging table."""
+    sql = f"SELECT * FROM `{project_id}.{staging_ref.dataset_id}.{staging_ref.table_id}`"
+    job_config = bigquery.QueryJobConfig(
+        destination=f"{project_id}.{table_ref.dataset_id}.{table_ref.table_id}",
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    client.query(sql, job_config=job_config).result()
+    client.delete_table(staging_ref, not_found_ok=True)
+    print(f"Published full load into {project_id}.{table_ref.dataset_id}.{table_ref.table_id}")
@@ -0,0 +1,143 @@
+import time
+import random
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+import requests
+
+# Local stand-in for the backend: posts synthetic change events to
+# ingest_service.py so the batching and mapping path can be exercised without
+# the real API, e.g.
+#
+#   python etl/ingest_service.py --dry-run
+#   python etl/ingest_event_generator.py --rate 200 --count 5000
+
+MANAGERS = [("@anna_promo", "1001"), ("@max_tiktok", "1002"), ("@lena_music", "1003")]
+STATUSES = ["Paid", "Pending", "Declined", "Disput", "Pause", "Returned"]
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def promo_expense(i: int) -> dict:
+    nickname, manager_id = random.choice(MANAGERS)
+    return {
+        "id": i,
+        "telegram_manager_nickname": nickname,
+        "telegram_manager_id": manager_id,
+        "rate": str(random.choice([20, 35, 50])),
+        "currency": "USD",
+        "promo_platform": "TikTok",
+        "video_id": str(7_000_000_000_000_000_000 + i),
+        "profile_id": str(random.randint(1, 50)),
+        "views": random.randint(0, 10**6),
+        "likes": random.randint(0, 10**5),
+        "comments": random.randint(0, 10**3),
+        "shares": random.randint(0, 10**3),
+        "duplicate": False,
+        "deleted": False,
+        "updated_at": now_iso(),
+    }
+
+
+def payment_operation(i: int) -> dict:
+    nickname, manager_id = random.choice(MANAGERS)
+    return {
+        "id": i,
+        "status": random.choice(STATUSES),
+        "payment_usd_value": random.choice(["20,00", "35.50", "1 200.00", ""]),
+        "usd_value": round(random.uniform(10, 500), 2),
+        "promotional_quantities": random.randint(1, 10),
+        "promo_platform": "TikTok",
+        "telegram_manager_nickname": nickname,
+        "telegram_manager_id": manager_id,
+        "profile_id": str(random.randint(1, 50)),
+        "payment_date": str(date.today()),
+        "deleted": False,
+        "updated_at": now_iso(),
+    }
+
+
+def snapshot(i: int) -> dict:
+    return {
+        "id": i,
+        "promo_expense_id": random.randint(1, 1000),
+        "views": random.randint(0, 10**6),
+        "likes": random.randint(0, 10**5),
+        "comments": random.randint(0, 10**3),
+        "shares": random.randint(0, 10**3),
+        "snapshot_date": str(date.today()),
+        "created_at": now_iso(),
+    }
+
+
+def promo_track(i: int) -> dict:
+    days = [str(date.today() - timedelta(days=d)) for d in range(28)]
+
+    def series():
+        return {"current_period_timeseries": [{"x": d, "y": random.randint(0, 5000)} for d in days]}
+
+    return {
+        "id": i,
+        "isrc": f"QZTEST{i:06d}",
+        "track_title": f"Track {i}",
+        "artist_name": "Test Artist",
+        "sp_json": {
+            "data": {
+                m: series()
+                for m in ["saves", "streams", "listeners", "playlist_adds", "streams_per_listener"]
+            },
+            "source_of_streams": {"user": 10, "other": 1, "catalog": 5},
+            "streams_by_country": {
+                "geography": [{"name": c, "num": random.randint(0, 9999), "localized_country": c}
+                              for c in ["US", "DE", "GE", "BR"]]
+            },
+        },
+    }
+
+
+GENERATORS = {
+    "promo_expenses": promo_expense,
+    "payment_operations": payment_operation,
+    "snapshots": snapshot,
+    "promo_tracks": promo_track,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post synthetic change events to the ingest service")
+    parser.add_argument("--url", default="http://localhost:8080/events")
+    parser.add_argument("--token", help="X-Ingest-Token, if the service requires one")
+    parser.add_argument("--count", type=int, default=1000, help="total events to send")
+    parser.add_argument("--rate", type=float, default=100, help="events per second")
+    parser.add_argument("--batch", type=int, default=20, help="events per request")
+    parser.add_argument("--ids", type=int, default=500,
+                        help="id space per entity; smaller means more updates to the same records")
+    args = parser.parse_args()
+
+    headers = {"X-Ingest-Token": args.token} if args.token else {}
+    sent = 0
+    start = time.time()
+    while sent < args.count:
+        events = []
+        for _ in range(min(args.batch, args.count - sent)):
+            entity = random.choice(list(GENERATORS))
+            op = random.choices(["created", "updated", "deleted"], weights=[3, 6, 1])[0]
+            events.append({"entity": entity, "op": op, "record": GENERATORS[entity](random.randint(1, args.ids))})
+
+        resp = requests.post(args.url, json=events, headers=headers, timeout=10)
+        resp.raise_for_status()
+        sent += len(events)
+
+        # pace to the requested rate
+        ahead = sent / args.rate - (time.time() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    elapsed = time.time() - start
+    print(f"Sent {sent} events in {elapsed:.1f}s ({sent / elapsed:.0f}/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import signal
+import argparse
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+import bq_upsert
+import dead_letter
+import managers
+import run_state
+import payment_operations_to_bigquery as payment_operations
+import promo_exp_to_bigquery as promo_exp
+import spotify_timeseries_to_bigquery as spotify_timeseries
+import spotify_tracks_to_bigquery as spotify_tracks
+import tiktok_posts
+import tiktok_snaps_to_bigquery as tiktok_snaps
+
+# Push-based alternative to the 3-hourly polling: the backend POSTs change
+# events to /events, they are micro-batched per entity and flushed to BigQuery
+# with the same row mappers the polling scripts use.
+#
+# Event: {"entity": "payment_operations", "op": "created" | "updated" | "deleted",
+#         "record": {...same shape as the admin API returns...}}
+
+MAX_BATCH_EVENTS = int(os.environ.get("INGEST_MAX_BATCH_EVENTS", "500"))
+MAX_BATCH_AGE = float(os.environ.get("INGEST_MAX_BATCH_AGE", "10"))  # seconds
+OPS = ("created", "updated", "deleted")
+
+
+def get_bq_client() -> bigquery.Client:
+    project_id = os.environ["GCP_PROJECT_ID"]
+    sa_key_json = os.environ["GCP_SERVICE_ACCOUNT_KEY"]
+    info = json.loads(sa_key_json)
+    credentials = service_account.Credentials.from_service_account_info(info)
+    return bigquery.Client(project=project_id, credentials=credentials)
+
+
+def promo_track_rows(flatten):
+    # the polling script skips tracks without isrc or sp_json, so does the service;
+    # wraps() keeps flatten's name, which is what a quarantined record is replayed with
+    @functools.wraps(flatten)
+    def rows(track):
+        if not track.get("isrc") or not track.get("sp_json"):
+            return []
+        return flatten(track)
+    return rows
+
+
+def entities():
+    """
+    Entity -> how to find its record key, whether deletes are soft (the table
+    has a `deleted` column the polling load fills), the polling jobs that load
+    the same tables, and the tables it feeds as (dataset_id, table_id, key
+    column, record key getter, mapper). A mapper returns one row or a list of
+    rows for a record. An entity with a "rollup" (RollupRefresh) has it
+    refreshed after its writes.
+    """
+    ts_tables = spotify_timeseries.table_ids()
+    post_tables = tiktok_posts.table_ids()
+    isrc = lambda r: r.get("isrc")  # noqa: E731
+    record_id = lambda r: r.get("id")  # noqa: E731
+    return {
+        "promo_expenses": {
+            "soft_delete": True,
+            "jobs": ["promo_exp"],
+            "tables": [
+                (
+                    os.environ.get("BQ_DATASET_ID", "raw_tiktok"),
+                    os.environ.get("BQ_TABLE_ID", "promo_exp"),
+                    "id", record_id, promo_exp.to_bq_row,
+                ),
+                # the TikTok post in json_data, shredded like the polling load does
+                (*post_tables["posts"], "post_id", tiktok_posts.post_id, tiktok_posts.post_rows),
+                (*post_tables["hashtags"], "post_id", tiktok_posts.post_id, tiktok_posts.hashtag_rows),
+            ],
+        },
+        "payment_operations": {
+            "soft_delete": True,
+            "jobs": ["payment_operations"],
+            "tables": [
+                (
+                    os.environ.get("BQ_PAYOPS_DATASET_ID", "raw_tiktok"),
+                    os.environ.get("BQ_PAYOPS_TABLE_ID", "payment_operations"),
+                    "id", record_id, payment_operations.to_row,
+                ),
+            ],
+            # the dashboard reads the rollup, which the polling load rebuilds at its end
+            "rollup": payment_operations.RollupRefresh(
+                os.environ.get("BQ_PAYOPS_DATASET_ID", "raw_tiktok"),
+                os.environ.get("BQ_PAYOPS_TABLE_ID", "payment_operations"),
+                os.environ.get("BQ_PAYOPS_ROLLUP_TABLE_ID", "payment_operations_rollup"),
+            ),
+        },
+        "snapshots": {
+            "soft_delete": False,
+            "jobs": ["tiktok_snaps"],
+            "tables": [
+                (
+                    os.environ.get("BQ_SNAPS_DATASET_ID", "raw_tiktok"),
+                    os.environ.get("BQ_SNAPS_TABLE_ID", "tiktok_snaps"),
+                    "id", record_id, tiktok_snaps.to_bq_row,
+                ),
+            ],
+        },
+        "promo_tracks": {
+            "soft_delete": False,
+            "jobs": ["spotify_tracks", "spotify_timeseries"],
+            "tables": [
+                (
+                    os.environ.get("BQ_SPOTIFY_TRACKS_DATASET_ID", "raw_tiktok"),
+                    os.environ.get("BQ_SPOTIFY_TRACKS_TABLE_ID", "spotify_tracks"),
+                    "id", record_id, spotify_tracks.to_bq_row,
+                ),
+                (*ts_tables["ts"], "isrc", isrc,
+                 promo_track_rows(spotify_timeseries.flatten_sp_json)),
+                (*ts_tables["src"], "isrc", isrc,
+                 promo_track_rows(spotify_timeseries.flatten_source_of_streams)),
+                (*ts_tables["ctry"], "isrc", isrc,
+                 promo_track_rows(spotify_timeseries.flatten_streams_by_country)),
+            ],
+        },
+    }
+
+
+class Batcher:
+    """
+    Collects events per entity, keeping only the latest event per record id.
+    An entity is due once it holds MAX_BATCH_EVENTS records or its oldest
+    event is MAX_BATCH_AGE seconds old; the flusher thread writes it, so
+    request handlers never wait on BigQuery.
+    """
+
+    def __init__(self, flush_fn):
+        self.flush_fn = flush_fn
+        self.lock = threading.Lock()
+        self.wake = threading.Event()  # set when a batch fills up before its age is reached
+        self.pending = {}  # entity -> {record id: (op, record)}
+        self.first_seen = {}  # entity -> time of the oldest pending event
+        self.flush_locks = {}  # one flush per entity at a time, so batches land in order
+
+    def add(self, entity: str, op: str, record: dict):
+        with self.lock:
+            batch = self.pending.setdefault(entity, {})
+            self.first_seen.setdefault(entity, time.time())
+            batch[str(record.get("id"))] = (op, record)
+            full = len(batch) >= MAX_BATCH_EVENTS
+        if full:
+            self.wake.set()
+
+    def due(self):
+        now = time.time()
+        with self.lock:
+            return [
+                e for e, t in self.first_seen.items()
+                if now - t >= MAX_BATCH_AGE or len(self.pending[e]) >= MAX_BATCH_EVENTS
+            ]
+
+    def flush(self, entity: str):
+        with self.lock:
+            flush_lock = self.flush_locks.setdefault(entity, threading.Lock())
+        with flush_lock:
+            with self.lock:
+                batch = self.pending.pop(entity, None)
+                self.first_seen.pop(entity, None)
+            if not batch:
+                return
+            try:
+                self.flush_fn(entity, list(batch.values()))
+            except Exception as e:
+                print(f"Flush of {entity} failed, will retry: {e}")
+                with self.lock:
+                    # events that arrived meanwhile are newer and win
+                    merged = dict(batch)
+                    merged.update(self.pending.get(entity, {}))
+                    self.pending[entity] = merged
+                    self.first_seen[entity] = time.time()
+
+    def flush_all(self):
+        with self.lock:
+            names = list(self.pending)
+        for entity in names:
+            self.flush(entity)
+
+    def sizes(self):
+        with self.lock:
+            return {e: len(b) for e, b in self.pending.items()}
+
+
+def make_flush(client, project_id: str, config: dict, dlq: dead_letter.DeadLetter):
+    def flush(entity: str, events):
+        spec = config[entity]
+        if spec["soft_delete"]:
+            # the polling load keeps soft-deleted records with deleted = true
+            events = [
+                ("updated", dict(r, deleted=True)) if op == "deleted" else (op, r)
+                for op, r in events
+            ]
+
+        # map every event before writing anything. A record whose mapper
+        # raises is quarantined for that table and its current rows there are
+        # left alone; quarantining waits for the writes, so a failed flush
+        # that is retried doesn't quarantine the record twice
+        writes, failures = [], []
+        for dataset_id, table_id, key, record_key, mapper in spec["tables"]:
+            keys, rows = [], []
+            for op, record in events:
+                try:
+                    mapped = [] if op == "deleted" else dead_letter.apply(mapper, record)
+                except Exception as e:
+                    failures.append((f"{dataset_id}.{table_id}", dead_letter.mapper_name(mapper), record, repr(e)))
+                    continue
+                keys.append(record_key(record))
+                rows.extend(mapped)
+            writes.append((dataset_id, table_id, key, keys, rows))
+
+        rollup = spec.get("rollup")
+        if rollup is not None and client is not None:
+            ids = [r.get("id") for _, r in events]
+            # an operation that moves to another profile changes that one's rollup too
+            before = rollup.profiles(client, project_id, ids)
+
+        for dataset_id, table_id, key, keys, rows in writes:
+            if client is None:
+                print(f"[dry-run] {dataset_id}.{table_id}: replace {len(keys)} keys with {len(rows)} rows")
+                continue
+            bq_upsert.replace_by_key(client, project_id, dataset_id, table_id, key, keys, rows)
+            print(f"Flushed {entity} to {dataset_id}.{table_id}: keys={len(keys)}, rows={len(rows)}")
+
+        if rollup is not None and client is not None:
+            try:
+                rollup.refresh(client, project_id, ids, before)
+            except Exception as e:
+                # the profiles stay pending and are refreshed with the next flush
+                print(f"Refreshing the {entity} rollup failed: {e}")
+
+        dlq.map_failures(failures)
+        try:
+            dlq.flush()
+        except Exception as e:
+            # the batch itself is written; the entries stay in ETL_DEAD_LETTER_DIR
+            print(f"Writing dead-letter entries to BigQuery failed: {e}")
+        if client is not None:
+            try:
+                managers.flush()
+            except Exception as e:
+                # the new managers stay in memory and go out with the next flush
+                print(f"Writing new managers to BigQuery failed: {e}")
+    return flush
+
+
+def make_handler(batcher: Batcher, config: dict, token):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._reply(404, {"success": False, "error": "not found"})
+            self._reply(200, {"success": True, "pending": batcher.sizes()})
+
+        def do_POST(self):
+            if self.path != "/events":
+                return self._reply(404, {"success": False, "error": "not found"})
+            if token and self.headers.get("X-Ingest-Token") != token:
+                return self._reply(401, {"success": False, "error": "unauthorized"})
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self._reply(400, {"success": False, "error": "invalid JSON"})
+
+            events = body if isinstance(body, list) else [body]
+            for i, event in enumerate(events):
+                if (
+                    not isinstance(event, dict)
+                    or event.get("entity") not in config
+                    or event.get("op") not in OPS
+                    or not isinstance(event.get("record"), dict)
+                    or event["record"].get("id") is None
+                ):
+                    return self._reply(400, {"success": False, "error": f"invalid event at index {i}"})
+
+            for event in events:
+                batcher.add(event["entity"], event["op"], event["record"])
+            self._reply(202, {"success": True, "accepted": len(events)})
+
+        def log_message(self, fmt, *args):
+            pass  # one line per request is too noisy at event rates
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive change events and micro-batch them into BigQuery")
+    parser.add_argument("--host", default=os.environ.get("INGEST_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("INGEST_PORT", "8080")))
+    parser.add_argument("--dry-run", action="store_true",
+                        help="map and batch events, but print flushes instead of writing to BigQuery")
+    args = parser.parse_args()
+
+    config = entities()
+    for entity, spec in config.items():
+        polling = [j for j in spec["jobs"] if j not in run_state.PUSH_FED_JOBS]
+        if polling:
+            # their streamed rows would make this service's flushes fail for up to ~90 minutes
+            print(f"Warning: {entity} is still polled by {polling}; add them to ETL_PUSH_FED_JOBS")
+    if args.dry_run:
+        client, project_id = None, None
+    else:
+        client, project_id = get_bq_client(), os.environ["GCP_PROJECT_ID"]
+        # promo expense and payment rows carry a manager_id resolved from the manager dimension
+        for entity in ("promo_expenses", "payment_operations"):
+            dataset_id, table_id = config[entity]["tables"][0][:2]
+            managers.ensure_column(client, client.dataset(dataset_id).table(table_id))
+        managers.load(client, project_id)
+
+    keys = {
+        f"{dataset_id}.{table_id}": (key, record_key)
+        for spec in config.values()
+        for dataset_id, table_id, key, record_key, _ in spec["tables"]
+    }
+    dlq = dead_letter.DeadLetter("ingest_service", client, project_id, keys=keys)
+    batcher = Batcher(make_flush(client, project_id, config, dlq))
+    stop = threading.Event()
+
+    def flush_loop():
+        while not stop.is_set():
+            batcher.wake.wait(1.0)
+            batcher.wake.clear()
+            for entity in batcher.due():
+                batcher.flush(entity)
+
+    flusher = threading.Thread(target=flush_loop, daemon=True)
+    flusher.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, config, os.environ.get("INGEST_TOKEN")))
+    # flush what is pending on shutdown; server.shutdown() must run off the serving thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop.set()
+        batcher.wake.set()
+        flusher.join()
+        batcher.flush_all()
+        print("Flushed pending events, stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import json
+import codecs
+
+# Incremental reader for API responses shaped like {"success": true, "data": [...]}:
+# yields the elements of the top-level "data" array one by one while the body is
+# still downloading, so a page of large documents is never held in memory at once.
+
+_WS = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _Buffer:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self) -> bool:
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.text += self.utf8.decode(b"", final=True)
+            self.eof = True
+            return False
+        self.text += self.utf8.decode(chunk)
+        return True
+
+    def _compact(self):
+        if self.pos > 65536:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+
+    def peek(self) -> str:
+        """Next non-whitespace character, or "" at the end of the input."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            self._compact()
+            if not self._read():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at position {self.pos}, got {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    self._compact()
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # incomplete: read at least as much again before retrying, so a
+            # large value is re-parsed a logarithmic number of times
+            target = 2 * (len(self.text) - self.pos) + 1
+            while len(self.text) - self.pos < target and self._read():
+                pass
+
+
+def iter_array(chunks, key: str = "data"):
+    """
+    Yield the items of the top-level `key` array of a JSON object given as an
+    iterable of byte chunks (e.g. resp.iter_content()). Other top-level values
+    are decoded and skipped.
+    """
+    buf = _Buffer(chunks)
+    buf.expect("{")
+    while buf.peek() != "}":
+        if buf.peek() == ",":
+            buf.expect(",")
+        name = buf.value()
+        buf.expect(":")
+        if name != key:
+            buf.value()
+            continue
+
+        buf.expect("[")
+        while buf.peek() != "]":
+            if buf.peek() == ",":
+                buf.expect(",")
+            yield buf.value()
+        buf.expect("]")
+    buf.expect("}")
@@ -0,0 +1,130 @@
+import os
+import threading
+from datetime import datetime, timezone
+from google.cloud import bigquery
+
+# Manager dimension (telegram nickname -> telegram manager id), kept up to
+# date at ingestion by promo_exp and payment_operations instead of being
+# rebuilt from all of promo_exp on every Dataform run. A run loads the known
+# pairs once, resolves the manager_id of every row from memory, and appends
+# only the pairs it saw for the first time.
+
+SCHEMA = [
+    bigquery.SchemaField("telegram_manager_nickname", "STRING"),
+    bigquery.SchemaField("telegram_manager_id", "STRING"),
+    bigquery.SchemaField("first_seen_at", "TIMESTAMP"),
+]
+
+MANAGER_ID_FIELD = bigquery.SchemaField("manager_id", "STRING")
+
+_cache = None  # ManagerCache of this process, set by load()
+
+
+def table_id():
+    return (
+        os.environ.get("BQ_MANAGERS_DATASET_ID", "raw_tiktok"),
+        os.environ.get("BQ_MANAGERS_TABLE_ID", "managers"),
+    )
+
+
+def ensure_column(client: bigquery.Client, table_ref) -> bool:
+    """
+    Add the manager_id column to a table that lacks it. Returns True if it was
+    added. Full loads stream into a staging table created with the target's
+    schema, so they never stream into a column that was just added.
+    """
+    table = client.get_table(table_ref)
+    if any(f.name == MANAGER_ID_FIELD.name for f in table.schema):
+        return False
+    sql = f"""
+    ALTER TABLE `{table.project}.{table.dataset_id}.{table.table_id}`
+    ADD COLUMN IF NOT EXISTS {MANAGER_ID_FIELD.name} {MANAGER_ID_FIELD.field_type}
+    """
+    client.query(sql).result()
+    print(f"Added column manager_id to {table.project}.{table.dataset_id}.{table.table_id}")
+    return True
+
+
+class ManagerCache:
+    def __init__(self, client: bigquery.Client, project_id: str):
+        self.client = client
+        dataset_id, table_name = table_id()
+        table = bigquery.Table(client.dataset(dataset_id).table(table_name), schema=SCHEMA)
+        self.ref = client.create_table(table, exists_ok=True).reference
+        self.lock = threading.Lock()
+
+        sql = f"""
+        SELECT telegram_manager_nickname, telegram_manager_id
+        FROM `{project_id}.{dataset_id}.{table_name}`
+        ORDER BY first_seen_at
+        """
+        self.pairs = set()
+        self.ids = {}  # nickname -> its most recently seen manager id
+        for r in client.query(sql).result():
+            self._add(r.telegram_manager_nickname, r.telegram_manager_id)
+        self.new = []
+        print(f"Loaded {len(self.pairs)} managers from {project_id}.{dataset_id}.{table_name}")
+
+    def _add(self, nickname, manager_id):
+        self.pairs.add((nickname, manager_id))
+        if nickname is not None:
+            self.ids[nickname] = manager_id
+
+    def resolve(self, nickname, manager_id):
+        """
+        The record's own manager id if it has one, remembering the pair;
+        otherwise the id last seen with its nickname.
+        """
+        with self.lock:
+            if manager_id is None:
+                return self.ids.get(nickname)
+            manager_id = str(manager_id)
+            if (nickname, manager_id) not in self.pairs:
+                self._add(nickname, manager_id)
+                self.new.append({
+                    "telegram_manager_nickname": nickname,
+                    "telegram_manager_id": manager_id,
+                    "first_seen_at": datetime.now(timezone.utc).isoformat(),
+                })
+            return manager_id
+
+    def flush(self):
+        """Append the pairs first seen since the last flush."""
+        with self.lock:
+            rows, self.new = self.new, []
+        if not rows:
+            return
+        job_config = bigquery.LoadJobConfig(
+            schema=SCHEMA,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        try:
+            self.client.load_table_from_json(rows, self.ref, job_config=job_config).result()
+        except Exception:
+            with self.lock:
+                self.new = rows + self.new
+            raise
+        print(f"Appended {len(rows)} new managers to {self.ref.dataset_id}.{self.ref.table_id}")
+
+
+def load(client: bigquery.Client, project_id: str) -> ManagerCache:
+    """Load the dimension for this process; resolve() answers from it from now on."""
+    global _cache
+    _cache = ManagerCache(client, project_id)
+    return _cache
+
+
+def resolve(record: dict):
+    """
+    manager_id of an API record. Without a loaded cache (a dead-letter
+    replay, a dry run) it is just the record's own telegram_manager_id.
+    """
+    manager_id = record.get("telegram_manager_id")
+    if _cache is None:
+        return str(manager_id) if manager_id is not None else None
+    return _cache.resolve(record.get("telegram_manager_nickname"), manager_id)
+
+
+def flush():
+    if _cache is not None:
+        _cache.flush()
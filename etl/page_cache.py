@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+
+import run_state
+
+# Per-page validators of the last completed load of a job, kept in
+# ETL_STATE_DIR/<job>.pages.json next to its run state:
+#   {offset: {"etag", "last_modified", "sha256", "ids", "refs"}}
+# Pages are requested with If-None-Match / If-Modified-Since; a 304, or a 200
+# whose body has the cached checksum, means the page is unchanged and is not
+# decoded, transformed or loaded again. ids are the record keys the page
+# contributed, so rows of a changed or vanished page can be replaced by key;
+# refs are keys of rows in other tables its records point to (the posts of
+# promo expenses), so rows no page points to any more can be deleted.
+
+
+def _path(job: str) -> str:
+    return os.path.join(run_state.STATE_DIR, f"{job}.pages.json")
+
+
+class PageCache:
+    def __init__(self, job: str):
+        self.job = job
+        try:
+            with open(_path(job)) as f:
+                self.pages = json.load(f)["pages"]
+        except FileNotFoundError:
+            self.pages = {}
+        self.seen = {}      # offset -> entry, for every non-empty page of this run
+        self.changed = set()
+        self._fresh = {}    # offset -> entry of a changed page, until page_loaded
+
+    @property
+    def primed(self) -> bool:
+        """True when the cache describes a complete earlier load of the table."""
+        return bool(self.pages)
+
+    def track(self, run: dict):
+        """
+        Keep this run's page entries in its checkpoint, so a full load that
+        yields at its deadline still leaves a complete cache when it finishes.
+        """
+        self.seen = run.setdefault("pages", {})
+
+    def validators(self, offset: int) -> dict:
+        """Conditional request headers for the page at offset."""
+        entry = self.pages.get(str(offset)) or {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def unchanged(self, offset: int, resp) -> bool:
+        """
+        Check a page response against the cache. Unchanged pages are marked
+        seen right away; a changed one is marked seen by page_loaded.
+        """
+        key = str(offset)
+        old = self.pages.get(key)
+        if resp.status_code == 304 and old is not None:
+            self.seen[key] = old
+            return True
+
+        entry = self.record(offset, resp)
+        if old is not None and old.get("sha256") == entry["sha256"]:
+            del self._fresh[key]
+            self.seen[key] = dict(entry, ids=old["ids"], refs=old.get("refs", []))
+            return True
+        return False
+
+    def record(self, offset: int, resp) -> dict:
+        """Take the validators and checksum of a fetched page, to be stored by page_loaded."""
+        entry = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "sha256": hashlib.sha256(resp.content).hexdigest(),
+            "ids": [],
+            "refs": [],
+        }
+        self._fresh[str(offset)] = entry
+        return entry
+
+    def page_loaded(self, offset: int, ids, complete: bool = True, refs=()):
+        """
+        Record the keys (and refs) of a changed page once its rows are
+        written. A page that lost records to the dead-letter quarantine is
+        stored without validators, so the next run fetches and loads it again.
+        """
+        key = str(offset)
+        entry = self._fresh.pop(key)
+        entry["ids"] = sorted({str(i) for i in ids if i is not None})
+        entry["refs"] = sorted({str(r) for r in refs if r is not None})
+        if not complete:
+            entry.update(etag=None, last_modified=None, sha256=None)
+        self.seen[key] = entry
+        self.changed.add(key)
+
+    def all_unchanged(self) -> bool:
+        """True when every page came back unchanged and none disappeared."""
+        return not self.changed and self.seen.keys() == self.pages.keys()
+
+    def stale_keys(self):
+        """Keys to replace: old and new ids of changed pages, and ids of vanished pages."""
+        keys = set()
+        for key, entry in self.pages.items():
+            if key in self.changed or key not in self.seen:
+                keys.update(entry["ids"])
+        for key in self.changed:
+            keys.update(self.seen[key]["ids"])
+        return keys
+
+    def referenced(self):
+        """refs of every page of this run."""
+        return {r for entry in self.seen.values() for r in entry.get("refs", [])}
+
+    def dropped_refs(self):
+        """refs of the last load that no page of this run has any more."""
+        return {r for entry in self.pages.values() for r in entry.get("refs", [])} - self.referenced()
+
+    def row_count(self) -> int:
+        return sum(len(entry["ids"]) for entry in self.seen.values())
+
+    def digest(self) -> str:
+        """Hash over the page checksums, for run_state's change detection."""
+        h = hashlib.sha256()
+        for key in sorted(self.seen, key=int):
+            h.update((self.seen[key].get("sha256") or "").encode("utf-8"))
+        return h.hexdigest()
+
+    def save(self):
+        os.makedirs(run_state.STATE_DIR, exist_ok=True)
+        tmp = _path(self.job) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"pages": self.seen}, f)
+        os.replace(tmp, _path(self.job))
+        self.pages = self.seen
+
+    def clear(self):
+        """Forget the cache: the next run reloads the whole table."""
+        try:
+            os.remove(_path(self.job))
+        except FileNotFoundError:
+            pass
+        self.pages = {}
@@ -0,0 +1,96 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Runs the CPU-bound per-page transform (json decode + flatten) in a process
+# pool. The main process keeps fetching pages while workers transform earlier
+# ones; raw page bytes go to the workers and rows come back as columns
+# ({column: [values]}) rather than lists of dicts, which pickle much smaller.
+
+
+def to_columns(rows):
+    # from_columns zips the columns back together, so every row needs the same keys
+    columns = {key: [] for key in (rows[0] if rows else ())}
+    for row in rows:
+        if row.keys() != columns.keys():
+            raise ValueError(f"row keys {sorted(row)} differ from {sorted(columns)}")
+        for key, value in row.items():
+            columns[key].append(value)
+    return len(rows), columns
+
+
+def from_columns(packed):
+    n, columns = packed
+    if not n:
+        return []
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+
+def _in_flight(pending) -> int:
+    return sum(1 for _, _, job in pending if not isinstance(job, Exception) and not job.done())
+
+
+def _reached_end(pending, page_size: int) -> bool:
+    """
+    True once a page in flight was transformed and came back empty, or
+    shorter than a full page: nothing after it has data.
+    """
+    for _, _, job in pending:
+        if isinstance(job, Exception) or not job.done() or job.exception() is not None:
+            continue
+        if job.result()[0] < page_size:
+            return True
+    return False
+
+
+def imap_pages(fetch_raw, transform, offsets, workers: int):
+    """
+    Yield (offset, raw, result) for every page in offset order, where
+    result = transform(raw) was computed in a worker process and transform
+    returns (item_count, payload). Stops at the first page with no items.
+    Fetching stops early once a transformed page comes back short or empty,
+    and runs at most `workers` pages ahead of the pages known to be full, so
+    few requests are spent past the end of the stream.
+
+    Like the serial loop, a failing fetch or transform raises only once all
+    pages before it have been yielded.
+    """
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    offsets = iter(offsets)
+    fetching = True
+    page_size = 1  # largest item count seen so far, the API's page size once a full page came back
+    try:
+        while True:
+            # keep every worker busy, with one page queued behind each, but
+            # fetch ahead of at most `workers` pages not known to be full yet
+            while fetching and len(pending) < 2 * workers and _in_flight(pending) < workers:
+                if _reached_end(pending, page_size):
+                    # don't spend rate-limiter budget on pages past the end
+                    fetching = False
+                    break
+                offset = next(offsets, None)
+                if offset is None:
+                    fetching = False
+                    break
+                try:
+                    raw = fetch_raw(offset)
+                except Exception as e:
+                    pending.append((offset, None, e))
+                    fetching = False
+                    break
+                pending.append((offset, raw, pool.submit(transform, raw)))
+
+            if not pending:
+                return
+            offset, raw, job = pending.popleft()
+            if isinstance(job, Exception):
+                raise job
+
+            result = job.result()
+            if result[0] == 0:
+                return
+            page_size = max(page_size, result[0])
+            yield offset, raw, result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -1,12 +1,31 @@
 import os
 import json
-import requests
 import re
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import bq_upsert
+import dead_letter
+import full_load
+import managers
+import rate_limiter
+import run_state
+
 API_BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin"
 LIMIT = 500  # page size
+JOB_NAME = "payment_operations"
+
+ROLLUP_SCHEMA = [
+    bigquery.SchemaField("profile_id", "STRING"),
+    bigquery.SchemaField("profile_name", "STRING"),
+    bigquery.SchemaField("telegram_manager_id", "STRING"),
+    bigquery.SchemaField("promo_platform", "STRING"),
+    bigquery.SchemaField("status", "STRING"),
+    bigquery.SchemaField("operations_count", "INT64"),
+    bigquery.SchemaField("promotional_quantities", "INT64"),
+    bigquery.SchemaField("usd_value", "FLOAT64"),
+    bigquery.SchemaField("last_payment_date", "STRING"),
+]
 
 
 def get_bq_client() -> bigquery.Client:
@@ -28,7 +47,7 @@ def fetch_page(api_key: str, offset: int):
         "X-Admin-Api-Key": api_key,
         "Accept": "application/json",
     }
-    resp = requests.get(url, params=params, headers=headers, timeout=60)
+    resp = rate_limiter.get(url, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
@@ -67,6 +86,16 @@ def to_float(v):
         return None
 
 
+def to_quantity(v):
+    """promotional_quantities as an int. A non-integral count is an error, not something to round."""
+    q = to_float(v)
+    if q is None:
+        return None
+    if not q.is_integer():
+        raise ValueError(f"non-integral promotional_quantities: {v!r}")
+    return int(q)
+
+
 def to_bool(v):
     if v is None or v != v:
         return None
@@ -77,6 +106,8 @@ def to_row(x: dict) -> dict:
     """
     Map one payment_operations JSON object into BigQuery row.
     """
+    # a record with a non-integral count is quarantined (dlq.map) rather than rounded in the rollup
+    to_quantity(x.get("promotional_quantities"))
     return {
         "id": str(x.get("id")) if x.get("id") is not None else None,
         "coda_row_id": x.get("coda_row_id"),
@@ -102,6 +133,7 @@ def to_row(x: dict) -> dict:
 
         "telegram_manager_nickname": x.get("telegram_manager_nickname"),
         "telegram_manager_id": x.get("telegram_manager_id"),
+        "manager_id": managers.resolve(x),
 
         "task_id": x.get("task_id"),
         "profile_id": x.get("profile_id"),
@@ -118,40 +150,170 @@ def to_row(x: dict) -> dict:
     }
 
 
+def add_to_rollup(rollup: dict, row: dict):
+    """
+    Fold one mapped payment_operations row into the per
+    (profile_id, profile_name, telegram_manager_id, promo_platform, status) aggregate.
+    """
+    # raises before anything is counted, so a rejected row leaves the rollup as it was
+    quantities = to_quantity(row["promotional_quantities"])
+    profile_id = str(row["profile_id"]) if row["profile_id"] is not None else None
+    # resolved through the manager dimension, so operations with only a nickname count too
+    manager_id = row["manager_id"]
+    key = (
+        profile_id,
+        row["profile_name"],
+        manager_id,
+        row["promo_platform"],
+        row["status"],
+    )
+    agg = rollup.get(key)
+    if agg is None:
+        agg = rollup[key] = {
+            "profile_id": profile_id,
+            "profile_name": row["profile_name"],
+            "telegram_manager_id": manager_id,
+            "promo_platform": row["promo_platform"],
+            "status": row["status"],
+            "operations_count": 0,
+            "promotional_quantities": 0,
+            "usd_value": 0.0,
+            "last_payment_date": None,
+        }
+
+    agg["operations_count"] += 1
+
+    if quantities is not None:
+        agg["promotional_quantities"] += quantities
+
+    if row["usd_value"] is not None:
+        agg["usd_value"] += row["usd_value"]
+
+    payment_date = str(row["payment_date"]) if row["payment_date"] else None
+    if payment_date and (agg["last_payment_date"] is None or payment_date > agg["last_payment_date"]):
+        agg["last_payment_date"] = payment_date
+
+
+class RollupRefresh:
+    """
+    Keeps the rollup in step with keyed writes to payment_operations
+    (ingest_service.py): the profiles of the written ids, before and after
+    the write, get their rollup rows rebuilt from the table with add_to_rollup.
+    Profiles whose refresh failed are retried with the next one.
+    """
+
+    # the rollup rows of a profile, NULL profile_id included (as "")
+    KEY = ("profile_id",)
+
+    def __init__(self, dataset_id: str, table_id: str, rollup_table_id: str):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.rollup_table_id = rollup_table_id
+        self.pending = set()
+
+    def profiles(self, client: bigquery.Client, project_id: str, ids) -> set:
+        """Profiles the given payment operation ids currently belong to."""
+        ids = sorted({str(i) for i in ids if i is not None})
+        if not ids:
+            return set()
+        sql = f"""
+        SELECT DISTINCT {bq_upsert.key_sql(self.KEY)} AS profile_key
+        FROM `{project_id}.{self.dataset_id}.{self.table_id}`
+        WHERE CAST(id AS STRING) IN UNNEST(@ids)
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", ids)]
+        )
+        return {r["profile_key"] for r in client.query(sql, job_config=job_config).result()}
+
+    def refresh(self, client: bigquery.Client, project_id: str, ids, before=()):
+        """Rebuild the rollup rows of the profiles of ids, plus those they belonged to before the write."""
+        self.pending |= set(before)
+        self.pending |= self.profiles(client, project_id, ids)
+        if not self.pending:
+            return
+        keys = sorted(self.pending)
+        sql = f"""
+        SELECT profile_id, profile_name, manager_id, promo_platform, status,
+               promotional_quantities, usd_value, payment_date
+        FROM `{project_id}.{self.dataset_id}.{self.table_id}`
+        WHERE {bq_upsert.key_sql(self.KEY)} IN UNNEST(@profiles)
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("profiles", "STRING", keys)]
+        )
+        rollup = {}
+        for r in client.query(sql, job_config=job_config).result():
+            try:
+                add_to_rollup(rollup, dict(r.items()))
+            except ValueError as e:
+                # a row loaded before to_row rejected it; the next full load quarantines it
+                print(f"Left out of the rollup: {e}")
+        bq_upsert.replace_by_key(
+            client, project_id, self.dataset_id, self.rollup_table_id, self.KEY, keys, list(rollup.values())
+        )
+        print(f"Refreshed {len(rollup)} rollup rows of {len(keys)} profiles in "
+              f"{project_id}.{self.dataset_id}.{self.rollup_table_id}")
+        self.pending = set()
+
+
 def main():
+    if run_state.push_fed(JOB_NAME):
+        return
     project_id = os.environ["GCP_PROJECT_ID"]
     dataset_id = os.environ.get("BQ_PAYOPS_DATASET_ID", "raw_tiktok")
     table_id = os.environ.get("BQ_PAYOPS_TABLE_ID", "payment_operations")
+    rollup_table_id = os.environ.get("BQ_PAYOPS_ROLLUP_TABLE_ID", "payment_operations_rollup")
 
     api_key = os.environ["API_KEY"]
 
     client = get_bq_client()
     table_ref = client.dataset(dataset_id).table(table_id)
 
-    # *** Overwrite: clear table before inserting this run ***
-    truncate_sql = f"truncate table `{project_id}.{dataset_id}.{table_id}`"
-    print(f"Running: {truncate_sql}")
-    client.query(truncate_sql).result()
-    print("Table truncated before load")
-
-    offset = 0
-    total_rows = 0
+    column_added = managers.ensure_column(client, table_ref)
+    run = run_state.begin(JOB_NAME)
+    if column_added and run["resumed"]:
+        # the interrupted run's staging table has no manager_id: start over
+        run_state.abandon(JOB_NAME)
+        run = run_state.begin(JOB_NAME)
+    dlq = dead_letter.DeadLetter(
+        JOB_NAME, client, project_id, run, keys={dead_letter.table_name(table_ref): ("id", "id")}
+    )
+    managers.load(client, project_id)
+    # *** Overwrite: the run fills a staging table, published over the table at the end ***
+    staging_ref = full_load.staging_table(client, run, table_ref)
+
+    offset = run["offset"]
+    total_rows = run["rows"]
+    # the partial rollup travels in the checkpoint so a resumed run stays complete
+    rollup = {
+        (a["profile_id"], a["profile_name"], a["telegram_manager_id"], a["promo_platform"], a["status"]): a
+        for a in run.get("rollup", [])
+    }
 
     while True:
         items = fetch_page(api_key, offset)
         if not items:
             break
 
-        rows_to_insert = [to_row(x) for x in items]
-
-        errors = client.insert_rows_json(table_ref, rows_to_insert)
-        if errors:
-            raise RuntimeError(f"BigQuery payment_operations insert errors: {errors}")
+        rows_to_insert = dlq.map(table_ref, to_row, items)
+        inserted = dlq.insert(
+            table_ref, rows_to_insert, to_row, dead_letter.by_key(lambda: items, "id"), into=staging_ref
+        )
+        # quarantined rows stay out of the rollup until they are replayed and reloaded
+        for row in inserted:
+            add_to_rollup(rollup, row)
 
-        batch_count = len(rows_to_insert)
+        batch_count = len(inserted)
         total_rows += batch_count
         print(f"Inserted batch at offset={offset}, rows={batch_count}")
 
+        run["rollup"] = list(rollup.values())
+        if run_state.page_done(JOB_NAME, run, offset + LIMIT, items, batch_count):
+            managers.flush()
+            dlq.flush()
+            return
+
         if len(items) < LIMIT:
             break
         offset += LIMIT
@@ -161,6 +323,22 @@ def main():
         f"{project_id}.{dataset_id}.{table_id}"
     )
 
+    managers.flush()
+    dlq.finish()
+    full_load.publish(client, project_id, table_ref, staging_ref)
+
+    # Replace the rollup in one load job so the dashboard never sees a partial aggregate
+    rollup_ref = client.dataset(dataset_id).table(rollup_table_id)
+    job_config = bigquery.LoadJobConfig(
+        schema=ROLLUP_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    client.load_table_from_json(list(rollup.values()), rollup_ref, job_config=job_config).result()
+    print(
+        f"Loaded {len(rollup)} rollup rows into "
+        f"{project_id}.{dataset_id}.{rollup_table_id}"
+    )
+    run_state.finish(JOB_NAME, run)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,22 @@
 import os
 import json
-import requests
+import itertools
+import tempfile
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import bq_upsert
+import dead_letter
+import full_load
+import managers
+import page_cache
+import rate_limiter
+import run_state
+import tiktok_posts
+
 API_BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin"
 LIMIT = 500
+JOB_NAME = "promo_exp"
 
 
 def get_bq_client() -> bigquery.Client:
@@ -16,18 +27,22 @@ def get_bq_client() -> bigquery.Client:
     return bigquery.Client(project=project_id, credentials=credentials)
 
 
-def fetch_page(api_key: str, offset: int):
+def fetch_page_response(api_key: str, offset: int, conditional: dict = None):
     url = f"{API_BASE_URL}/promo-expenses"
     params = {
         "promo_platform": "TikTok",
         "limit": LIMIT,
         "offset": offset,
     }
-    headers = {"X-Admin-Api-Key": api_key}
-    resp = requests.get(url, params=params, headers=headers, timeout=60)
+    headers = {"X-Admin-Api-Key": api_key, **(conditional or {})}
+    resp = rate_limiter.get(url, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
+    return resp
+
+
+def parse_page(resp):
     data = resp.json()
 
     # API shape: {"success": true, "data": [...]}
@@ -35,51 +50,127 @@ def fetch_page(api_key: str, offset: int):
     return items
 
 
+def to_bq_row(x):
+    return {
+        "id": x["id"],
+        "coda_row_id": x.get("coda_row_id"),
+        "telegram_manager_nickname": x.get("telegram_manager_nickname"),
+        "telegram_manager_id": x.get("telegram_manager_id"),
+        "rate": x.get("rate"),
+        "currency": x.get("currency"),
+        "promo_link": x.get("promo_link"),
+        "promo_date": x.get("promo_date"),
+        "parsing_date": x.get("parsing_date"),
+        "promo_platform": x.get("promo_platform"),
+        "permanent_video_link": x.get("permanent_video_link"),
+        "raw_track_title": x.get("raw_track_title"),
+        "raw_artist_name": x.get("raw_artist_name"),
+        "video_id": x.get("video_id"),
+        "profile_id": x.get("profile_id"),
+        "profile_name": x.get("profile_name"),
+        "spotify_track_title": x.get("spotify_track_title"),
+        "spotify_artist_name": x.get("spotify_artist_name"),
+        "spotify_isrc": x.get("spotify_isrc"),
+        "spotify_upc": x.get("spotify_upc"),
+        "views": x.get("views"),
+        "likes": x.get("likes"),
+        "comments": x.get("comments"),
+        "shares": x.get("shares"),
+        "last_snapshot_date": x.get("last_snapshot_date"),
+        "created_in_coda": x.get("created_in_coda"),
+        "duplicate": x.get("duplicate"),
+        "original_sound": x.get("original_sound"),
+        "created_at": x.get("created_at"),
+        "updated_at": x.get("updated_at"),
+        "profile_link": x.get("profile_link"),
+        "deleted": x.get("deleted"),
+        "snapshots_count": x.get("snapshots_count"),
+        "sound_url": x.get("sound_url"),
+        "manager_id": managers.resolve(x),
+    }
+
+
 def to_bq_rows(items):
-    rows = []
-    for x in items:
-        rows.append(
-            {
-                "id": x["id"],
-                "coda_row_id": x.get("coda_row_id"),
-                "telegram_manager_nickname": x.get("telegram_manager_nickname"),
-                "telegram_manager_id": x.get("telegram_manager_id"),
-                "rate": x.get("rate"),
-                "currency": x.get("currency"),
-                "promo_link": x.get("promo_link"),
-                "promo_date": x.get("promo_date"),
-                "parsing_date": x.get("parsing_date"),
-                "promo_platform": x.get("promo_platform"),
-                "permanent_video_link": x.get("permanent_video_link"),
-                "raw_track_title": x.get("raw_track_title"),
-                "raw_artist_name": x.get("raw_artist_name"),
-                "video_id": x.get("video_id"),
-                "profile_id": x.get("profile_id"),
-                "profile_name": x.get("profile_name"),
-                "spotify_track_title": x.get("spotify_track_title"),
-                "spotify_artist_name": x.get("spotify_artist_name"),
-                "spotify_isrc": x.get("spotify_isrc"),
-                "spotify_upc": x.get("spotify_upc"),
-                "views": x.get("views"),
-                "likes": x.get("likes"),
-                "comments": x.get("comments"),
-                "shares": x.get("shares"),
-                "last_snapshot_date": x.get("last_snapshot_date"),
-                "created_in_coda": x.get("created_in_coda"),
-                "duplicate": x.get("duplicate"),
-                "original_sound": x.get("original_sound"),
-                "created_at": x.get("created_at"),
-                "updated_at": x.get("updated_at"),
-                "profile_link": x.get("profile_link"),
-                "deleted": x.get("deleted"),
-                "snapshots_count": x.get("snapshots_count"),
-                "sound_url": x.get("sound_url"),
-            }
+    return [to_bq_row(x) for x in items]
+
+
+def load_changed_pages(client: bigquery.Client, project_id: str, dataset_id: str, table_id: str,
+                       api_key: str, cache: page_cache.PageCache, dlq: dead_letter.DeadLetter, run: dict):
+    """
+    Incremental run against the page cache of the last load: only pages that
+    changed are decoded, and their rows replace the old ones by id. Rows of
+    pages that vanished are deleted, and so are the posts no promo expense
+    points to any more; nothing is written if no page changed. Returns False,
+    without fetching anything, while the table has a streaming buffer: the
+    caller then reloads it in full.
+    """
+    table_ref = client.dataset(dataset_id).table(table_id)
+    table = client.get_table(table_ref)
+    if table.streaming_buffer is not None:
+        print(f"{project_id}.{dataset_id}.{table_id} has rows in its streaming buffer, loading it in full")
+        return False
+    schema = table.schema
+    f = tempfile.NamedTemporaryFile("w+b", suffix=".ndjson")
+    total_rows = 0
+    posts = None  # reads the known post hashes and managers, so only built once a page changed
+
+    for offset in itertools.count(0, LIMIT):
+        resp = fetch_page_response(api_key, offset, cache.validators(offset))
+        if cache.unchanged(offset, resp):
+            continue
+        items = parse_page(resp)
+        if not items:
+            break
+
+        if posts is None:
+            managers.load(client, project_id)
+            posts = tiktok_posts.PostLoader(client, project_id, dlq)
+        rows = dlq.map(table_ref, to_bq_row, items)
+        dlq.count(len(rows))
+        # a row the staging load would reject is quarantined instead of failing the load
+        rows = dlq.validate(table_ref, schema, rows, to_bq_row, dead_letter.by_key(lambda: items, "id"))
+        for row in rows:
+            f.write(json.dumps(row).encode("utf-8") + b"\n")
+        total_rows += len(rows)
+
+        records = tiktok_posts.with_payloads(client, project_id, items)
+        posts.add(records)
+
+        cache.page_loaded(
+            offset, [x.get("id") for x in items], complete=len(rows) == len(items),
+            refs=tiktok_posts.live_post_ids(records),
         )
-    return rows
+        print(f"Changed page at offset={offset}, rows={len(rows)}")
+
+    if cache.all_unchanged():
+        print(f"No page changed, keeping {project_id}.{dataset_id}.{table_id} as is")
+    else:
+        try:
+            bq_upsert.replace_by_key_from_file(
+                client, project_id, dataset_id, table_id, "id", cache.stale_keys(), f, total_rows
+            )
+        except Exception:
+            # the table may no longer match the cache: reload it in full next run
+            cache.clear()
+            raise
+        print(f"Replaced {total_rows} changed rows in {project_id}.{dataset_id}.{table_id}")
+    f.close()
+    dropped = cache.dropped_refs()
+    if dropped and posts is None:
+        posts = tiktok_posts.PostLoader(client, project_id, dlq)
+    if posts is not None:
+        posts.load(deleted=dropped)
+        managers.flush()
+
+    cache.save()
+    run["rows"] = cache.row_count()
+    run["digest"] = cache.digest()
+    return True
 
 
 def main():
+    if run_state.push_fed(JOB_NAME):
+        return
     project_id = os.environ["GCP_PROJECT_ID"]
     dataset_id = os.environ.get("BQ_DATASET_ID", "raw_tiktok")
     table_id = os.environ.get("BQ_TABLE_ID", "promo_exp")
@@ -88,31 +179,78 @@ def main():
     client = get_bq_client()
     table_ref = client.dataset(dataset_id).table(table_id)
 
-    # Overwrite: clear table before inserting this run
-    truncate_sql = f"truncate table `{project_id}.{dataset_id}.{table_id}`"
-    print(f"Running: {truncate_sql}")
-    client.query(truncate_sql).result()
-    print("Table truncated before load")
+    column_added = managers.ensure_column(client, table_ref)
+    run = run_state.begin(JOB_NAME)
+    if column_added and run["resumed"]:
+        # the interrupted run's staging table has no manager_id: start over
+        run_state.abandon(JOB_NAME)
+        run = run_state.begin(JOB_NAME)
+    dlq = dead_letter.DeadLetter(
+        JOB_NAME, client, project_id, run, keys={dead_letter.table_name(table_ref): ("id", "id")}
+    )
+    cache = page_cache.PageCache(JOB_NAME)
+    if column_added:
+        # rows of unchanged pages would keep an empty manager_id
+        cache.clear()
+    if any("refs" not in entry for entry in cache.pages.values()):
+        # a cache from before the post refs can't tell which posts lost their promo expense
+        cache.clear()
+    if cache.primed and not run["resumed"]:
+        if load_changed_pages(client, project_id, dataset_id, table_id, api_key, cache, dlq, run):
+            dlq.finish()
+            run_state.finish(JOB_NAME, run)
+            return
 
-    offset = 0
-    total_rows = 0
+    managers.load(client, project_id)
+    posts = tiktok_posts.PostLoader(client, project_id, dlq)
+    if not run["resumed"]:
+        # the cache describes the table as this load leaves it, once published
+        cache.clear()
+    # Overwrite: the run fills a staging table, published over the table at the end
+    staging_ref = full_load.staging_table(client, run, table_ref)
+    # the full load rebuilds the page cache as it goes
+    cache.track(run)
+
+    offset = run["offset"]
+    total_rows = run["rows"]
 
     while True:
-        items = fetch_page(api_key, offset)
+        resp = fetch_page_response(api_key, offset)
+        cache.record(offset, resp)
+        items = parse_page(resp)
         if not items:
             break
 
-        rows = to_bq_rows(items)
-        errors = client.insert_rows_json(table_ref, rows)
-        if errors:
-            raise RuntimeError(f"BigQuery insert errors: {errors}")
+        rows = dlq.map(table_ref, to_bq_row, items)
+        inserted = dlq.insert(table_ref, rows, to_bq_row, dead_letter.by_key(lambda: items, "id"), into=staging_ref)
 
-        batch_count = len(rows)
+        records = tiktok_posts.with_payloads(client, project_id, items)
+        posts.add(records)
+        cache.page_loaded(
+            offset, [x.get("id") for x in items], complete=len(inserted) == len(items),
+            refs=tiktok_posts.live_post_ids(records),
+        )
+
+        batch_count = len(inserted)
         total_rows += batch_count
         print(f"Inserted batch at offset={offset}, rows={batch_count}")
         offset += LIMIT
 
+        if run_state.page_done(JOB_NAME, run, offset, items, batch_count):
+            posts.load()
+            managers.flush()
+            dlq.flush()
+            return
+
     print(f"Inserted total {total_rows} rows into {project_id}.{dataset_id}.{table_id}")
+    # every page has been seen: posts no live promo expense points to go
+    posts.load(deleted=set(posts.known) - cache.referenced())
+    managers.flush()
+    dlq.finish()
+    full_load.publish(client, project_id, table_ref, staging_ref)
+    cache.save()
+    run["digest"] = cache.digest()
+    run_state.finish(JOB_NAME, run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+# Shared by every ETL script that calls the admin API. State lives in one JSON
+# file per API host, guarded by an flock, so all jobs on the same machine draw
+# from the same token bucket and concurrency cap.
+
+STATE_DIR = os.environ.get(
+    "API_RATE_STATE_DIR", os.path.join(tempfile.gettempdir(), "0to8_rate_limiter")
+)
+RATE_PER_SEC = float(os.environ.get("API_RATE_PER_SEC", "2"))  # tokens refilled per second
+BURST = float(os.environ.get("API_RATE_BURST", "10"))  # bucket capacity
+MAX_CONCURRENCY = int(os.environ.get("API_MAX_CONCURRENCY", "2"))  # in-flight requests per host
+SLOT_TTL = 300  # seconds after which a slot of a crashed process is reclaimed
+MAX_429_RETRIES = 5
+
+# Cost of one request per endpoint, in tokens. Unknown endpoints cost 1.
+ENDPOINT_WEIGHTS = {
+    "/promo-tracks": 5,
+    "/creator-videos": 4,
+    "/promo-releases": 3,
+    "/promo-expenses": 2,
+    "/payment-operations": 1,
+    "/snapshots": 1,
+}
+
+
+def share_budget(parts: int):
+    """
+    Limit this process to 1/parts of the host's budget, for one of `parts`
+    workers that each run on their own machine (a workflow matrix job) and so
+    never see each other's state file. Concurrency can't go below 1 per
+    worker, and the bucket stays large enough for the heaviest endpoint.
+    """
+    global RATE_PER_SEC, BURST, MAX_CONCURRENCY
+    if parts <= 1:
+        return
+    RATE_PER_SEC /= parts
+    BURST = max(BURST / parts, max(ENDPOINT_WEIGHTS.values()))
+    MAX_CONCURRENCY = max(1, MAX_CONCURRENCY // parts)
+    print(f"API budget shared by {parts} workers: {RATE_PER_SEC:.2f} tokens/s, "
+          f"burst {BURST:.1f}, {MAX_CONCURRENCY} concurrent requests")
+
+
+def endpoint_weight(url: str) -> float:
+    path = urlparse(url).path.rstrip("/")
+    for endpoint, weight in ENDPOINT_WEIGHTS.items():
+        if path.endswith(endpoint):
+            return weight
+    return 1
+
+
+@contextmanager
+def _locked_state(host: str):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, f"{host}.json")
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            raw = f.read()
+            state = json.loads(raw) if raw else {}
+            state.setdefault("tokens", BURST)
+            state.setdefault("updated", time.time())
+            state.setdefault("blocked_until", 0)
+            state.setdefault("slots", {})
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _refill(state: dict, now: float):
+    elapsed = max(0.0, now - state["updated"])
+    state["tokens"] = min(BURST, state["tokens"] + elapsed * RATE_PER_SEC)
+    state["updated"] = now
+
+    # drop slots held by processes that died or hung past the TTL
+    state["slots"] = {
+        slot: info
+        for slot, info in state["slots"].items()
+        if _pid_alive(info["pid"]) and now - info["started"] < SLOT_TTL
+    }
+
+
+def _acquire(host: str, weight: float) -> str:
+    # a weight above the bucket size could never be satisfied
+    cost = min(weight, BURST)
+    while True:
+        now = time.time()
+        with _locked_state(host) as state:
+            _refill(state, now)
+            if (
+                now >= state["blocked_until"]
+                and len(state["slots"]) < MAX_CONCURRENCY
+                and state["tokens"] >= cost
+            ):
+                state["tokens"] -= cost
+                slot = uuid.uuid4().hex
+                state["slots"][slot] = {"pid": os.getpid(), "started": now}
+                return slot
+
+            if now < state["blocked_until"]:
+                wait = state["blocked_until"] - now
+            elif state["tokens"] < cost:
+                wait = (cost - state["tokens"]) / RATE_PER_SEC
+            else:
+                wait = 0.2  # waiting for a concurrency slot
+        time.sleep(min(max(wait, 0.05), 5.0))
+
+
+def _release(host: str, slot: str):
+    with _locked_state(host) as state:
+        state["slots"].pop(slot, None)
+
+
+def _back_off(host: str, seconds: float):
+    # a 429 means the backend is saturated: stop every job on this host and
+    # empty the bucket so they don't all retry at once
+    with _locked_state(host) as state:
+        state["blocked_until"] = max(state["blocked_until"], time.time() + seconds)
+        state["tokens"] = 0.0
+        state["updated"] = time.time()
+
+
+@contextmanager
+def api_slot(url: str):
+    host = urlparse(url).netloc
+    slot = _acquire(host, endpoint_weight(url))
+    try:
+        yield
+    finally:
+        _release(host, slot)
+
+
+def _rate_limited(host: str, resp: requests.Response, attempt: int):
+    retry_after = resp.headers.get("Retry-After")
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2 ** attempt
+    print(f"Rate limited by {host}, backing off {delay:.1f}s (attempt {attempt + 1})")
+    _back_off(host, delay)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    requests.get() that waits for a token and a concurrency slot on the
+    API host first, and backs off all jobs on 429 responses.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(MAX_429_RETRIES + 1):
+        with api_slot(url):
+            resp = requests.get(url, **kwargs)
+        if resp.status_code != 429 or attempt == MAX_429_RETRIES:
+            return resp
+        _rate_limited(host, resp, attempt)
+    return resp
+
+
+@contextmanager
+def stream(url: str, **kwargs):
+    """
+    get() with stream=True, as a context manager: the concurrency slot is
+    held until the body has been read and the response is closed, since
+    the download goes on while the caller consumes it.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(MAX_429_RETRIES + 1):
+        with api_slot(url):
+            resp = requests.get(url, stream=True, **kwargs)
+            with resp:
+                if resp.status_code != 429 or attempt == MAX_429_RETRIES:
+                    yield resp
+                    return
+        _rate_limited(host, resp, attempt)
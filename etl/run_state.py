@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import hashlib
+
+# Per-job run state kept in ETL_STATE_DIR/<job>.json:
+# - last successful load, average duration and observed source change rate,
+#   read by scheduler.py to decide what to run
+# - a checkpoint written after every loaded page, so a job that hits its
+#   deadline (ETL_DEADLINE, unix seconds) or gets killed resumes where it stopped
+
+STATE_DIR = os.environ.get("ETL_STATE_DIR", ".etl_state")
+EMA_ALPHA = 0.3  # weight of the latest run in the duration / change-rate averages
+# older checkpoints are dropped: offsets drift as the source changes, so a
+# resume is only trusted shortly after the interrupted run
+CHECKPOINT_MAX_AGE = float(os.environ.get("ETL_CHECKPOINT_MAX_AGE", str(6 * 3600)))
+# jobs whose tables ingest_service.py keeps up to date instead: their polling
+# loads publish a whole snapshot over the table, dropping what the service
+# wrote meanwhile, so they must not run alongside it
+PUSH_FED_JOBS = {j.strip() for j in os.environ.get("ETL_PUSH_FED_JOBS", "").split(",") if j.strip()}
+
+
+def _path(job: str) -> str:
+    return os.path.join(STATE_DIR, f"{job}.json")
+
+
+def load(job: str) -> dict:
+    try:
+        with open(_path(job)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save(job: str, state: dict):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = _path(job) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, _path(job))
+
+
+def push_fed(job: str) -> bool:
+    """True when the job's tables are fed by the ingest service and polling is off."""
+    if job in PUSH_FED_JOBS:
+        print(f"{job} is fed by ingest_service (ETL_PUSH_FED_JOBS), skipping the polling load")
+        return True
+    return False
+
+
+def deadline_reached() -> bool:
+    deadline = os.environ.get("ETL_DEADLINE")
+    return deadline is not None and time.time() >= float(deadline)
+
+
+def begin(job: str) -> dict:
+    """
+    Start a run, resuming from the job's checkpoint if one exists.
+    The returned dict is the run's progress and is passed back to page_done/finish.
+    """
+    checkpoint = load(job).get("checkpoint")
+    if checkpoint and time.time() - checkpoint["saved_at"] > CHECKPOINT_MAX_AGE:
+        print(f"Discarding stale checkpoint of {job} at offset={checkpoint['offset']}")
+        checkpoint = None
+    if checkpoint:
+        run = dict(checkpoint, resumed=True, started=time.time())
+        print(f"Resuming {job} from checkpoint at offset={run['offset']}")
+        return run
+    return {
+        "offset": 0,
+        "rows": 0,
+        "digest": "",
+        "elapsed": 0.0,
+        "resumed": False,
+        "started": time.time(),
+    }
+
+
+def page_done(job: str, run: dict, next_offset: int, items, rows: int) -> bool:
+    """
+    Record a loaded page in the checkpoint. Returns True when the job is past
+    its deadline and should stop now; the next run continues from next_offset.
+    """
+    # chained hash over all pages, so it survives checkpoints and tells the
+    # scheduler whether the source changed since the previous full load
+    # items may also be the raw page body, when the page was decoded elsewhere
+    page = items if isinstance(items, bytes) else json.dumps(items).encode("utf-8")
+    run["digest"] = hashlib.sha256(run["digest"].encode("utf-8") + page).hexdigest()
+    run["offset"] = next_offset
+    run["rows"] += rows
+
+    now = time.time()
+    checkpoint = {k: v for k, v in run.items() if k not in ("resumed", "started")}
+    checkpoint["elapsed"] = run["elapsed"] + now - run["started"]
+    checkpoint["saved_at"] = now
+
+    state = load(job)
+    state["checkpoint"] = checkpoint
+    save(job, state)
+
+    if deadline_reached():
+        print(f"Deadline reached for {job}, yielding at offset={next_offset}")
+        return True
+    return False
+
+
+def finish(job: str, run: dict):
+    now = time.time()
+    duration = run["elapsed"] + now - run["started"]
+
+    state = load(job)
+    changed = 1.0 if run["digest"] != state.get("digest") else 0.0
+    state["change_rate"] = EMA_ALPHA * changed + (1 - EMA_ALPHA) * state.get("change_rate", 1.0)
+    state["duration"] = EMA_ALPHA * duration + (1 - EMA_ALPHA) * state.get("duration", duration)
+    state["digest"] = run["digest"]
+    state["rows"] = run["rows"]
+    state["last_success"] = now
+    state.pop("checkpoint", None)
+    state.pop("last_error", None)
+    save(job, state)
+
+
+def abandon(job: str):
+    """Drop the checkpoint, so the next run starts over instead of resuming a failed one."""
+    state = load(job)
+    if state.pop("checkpoint", None) is not None:
+        save(job, state)
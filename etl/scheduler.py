@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import run_state
+
+# Staleness-driven scheduler: instead of running every job on a fixed cron,
+# run the jobs whose tables would miss their freshness SLA before the next
+# scheduler tick, most urgent first, within a time budget. Jobs get a deadline
+# (ETL_DEADLINE) after which they checkpoint and exit; the next tick resumes them.
+
+ETL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# sla_minutes: how stale a table may get when its source changes every cycle
+# max_staleness_minutes: hard limit, even for sources that rarely change
+JOBS = {
+    "promo_exp": {
+        "script": "promo_exp_to_bigquery.py",
+        "sla_minutes": 180,
+        "max_staleness_minutes": 720,
+    },
+    "payment_operations": {
+        "script": "payment_operations_to_bigquery.py",
+        "sla_minutes": 180,
+        "max_staleness_minutes": 720,
+    },
+    "tiktok_snaps": {
+        "script": "tiktok_snaps_to_bigquery.py",
+        "sla_minutes": 180,
+        "max_staleness_minutes": 720,
+    },
+    "spotify_tracks": {
+        "script": "spotify_tracks_to_bigquery.py",
+        "sla_minutes": 180,
+        "max_staleness_minutes": 1440,
+    },
+    "spotify_timeseries": {
+        "script": "spotify_timeseries_to_bigquery.py",
+        "sla_minutes": 360,
+        "max_staleness_minutes": 1440,
+    },
+    "ep_releases": {
+        "script": "ep_releases_to_bigquery.py",
+        "sla_minutes": 360,
+        "max_staleness_minutes": 1440,
+    },
+}
+# creator_videos is not scheduled here: it loads in one pass at the end and has
+# no checkpoint to resume from, so it can't yield at a deadline. It keeps its cron.
+
+DEFAULT_DURATION = 600  # seconds, until a job has a measured duration
+MIN_CHANGE_RATE = 0.1  # never stretch an SLA by more than 10x
+MIN_SLICE = 120  # seconds; not worth starting a job with less time than this
+KILL_GRACE = 120  # seconds past the deadline before a job is killed
+
+
+def effective_sla(job: dict, state: dict) -> float:
+    """
+    SLA in seconds, stretched for sources that rarely change between loads:
+    re-copying an unchanged table doesn't make it any fresher.
+    """
+    change_rate = max(state.get("change_rate", 1.0), MIN_CHANGE_RATE)
+    return min(job["sla_minutes"] / change_rate, job["max_staleness_minutes"]) * 60
+
+
+def plan(now: float, budget: float, interval: float):
+    """
+    Pick the jobs to run this tick, most urgent first. Returns
+    [(name, estimated_seconds)] and prints why every job was run or skipped.
+    """
+    due = []
+    for name, job in JOBS.items():
+        if name in run_state.PUSH_FED_JOBS:
+            print(f"Skip {name}: fed by ingest_service")
+            continue
+        state = run_state.load(name)
+        # a table that was never loaded (or whose state was lost) is infinitely stale
+        staleness = now - state["last_success"] if "last_success" in state else float("inf")
+        sla = effective_sla(job, state)
+        resuming = "checkpoint" in state
+
+        # a job is due if its table would breach the SLA before the next tick
+        if not resuming and staleness + interval < sla:
+            print(f"Skip {name}: {staleness / 60:.0f} min stale, SLA {sla / 60:.0f} min")
+            continue
+
+        urgency = (staleness + interval) / sla
+        if resuming:
+            urgency += 1  # finish interrupted loads before starting new ones
+        estimate = state.get("duration", DEFAULT_DURATION)
+        if resuming:
+            estimate = max(estimate - state["checkpoint"]["elapsed"], MIN_SLICE)
+        due.append((urgency, name, estimate))
+
+    due.sort(reverse=True)
+
+    planned = []
+    remaining = budget
+    for urgency, name, estimate in due:
+        if estimate <= remaining:
+            planned.append((name, estimate))
+            remaining -= estimate
+            print(f"Plan {name}: urgency {urgency:.2f}, est. {estimate / 60:.1f} min")
+
+    # spare budget goes to the most urgent job that doesn't fit: it runs until
+    # its deadline, checkpoints, and continues next tick
+    leftovers = [(u, n, e) for u, n, e in due if n not in dict(planned)]
+    if leftovers and remaining >= MIN_SLICE:
+        urgency, name, estimate = leftovers[0]
+        planned.append((name, remaining))
+        leftovers = leftovers[1:]
+        print(f"Plan {name}: urgency {urgency:.2f}, partial slice {remaining / 60:.1f} min")
+    for urgency, name, estimate in leftovers:
+        print(f"Defer {name}: urgency {urgency:.2f}, est. {estimate / 60:.1f} min exceeds budget")
+
+    return planned
+
+
+def run_job(name: str, deadline: float) -> bool:
+    script = os.path.join(ETL_DIR, JOBS[name]["script"])
+    env = dict(os.environ, ETL_DEADLINE=str(deadline))
+    print(f"Running {name} with deadline in {(deadline - time.time()) / 60:.1f} min")
+    try:
+        result = subprocess.run(
+            [sys.executable, script],
+            env=env,
+            timeout=max(deadline - time.time(), 0) + KILL_GRACE,
+        )
+        ok = result.returncode == 0
+        error = f"exit code {result.returncode}"
+    except subprocess.TimeoutExpired:
+        # progress up to the last loaded page is in the checkpoint
+        ok = False
+        error = "killed after deadline"
+
+    if not ok:
+        state = run_state.load(name)
+        state["last_error"] = error
+        run_state.save(name, state)
+        print(f"Job {name} failed: {error}")
+    elif "checkpoint" in run_state.load(name):
+        print(f"Job {name} yielded at its deadline, will resume next tick")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ETL jobs by staleness instead of a fixed cron")
+    parser.add_argument("--budget-minutes", type=float, default=150,
+                        help="total time this tick may spend running jobs")
+    parser.add_argument("--interval-minutes", type=float, default=60,
+                        help="time until the next scheduler tick")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the plan without running anything")
+    args = parser.parse_args()
+
+    start = time.time()
+    budget_end = start + args.budget_minutes * 60
+    planned = plan(start, args.budget_minutes * 60, args.interval_minutes * 60)
+    if args.dry_run or not planned:
+        return
+
+    failed = []
+    for i, (name, estimate) in enumerate(planned):
+        if budget_end - time.time() < MIN_SLICE:
+            print(f"Budget used up, deferring {[n for n, _ in planned[i:]]}")
+            break
+        # leave the estimated time of the jobs still queued after this one
+        reserved = sum(e for _, e in planned[i + 1:])
+        deadline = max(budget_end - reserved, time.time() + MIN_SLICE)
+        if not run_job(name, min(deadline, budget_end)):
+            failed.append(name)
+
+    if failed:
+        raise SystemExit(f"Failed jobs: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import os
+import json
+import argparse
+import tempfile
+import multiprocessing
+from google.cloud import bigquery
+
+import rate_limiter
+
+# Sharded extraction: the page space of an endpoint is split into N disjoint
+# shards (shard k fetches pages k, k + N, k + 2N, ... until it hits an empty
+# page). Every shard is loaded into its own staging table, and a coordinator
+# step validates all shards and merges them into the target table.
+
+SHARD_SUFFIX = "__shard"
+
+
+def parse_args(description: str):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--shard-count", type=int, default=0,
+                        help="number of shards the page space is split into")
+    parser.add_argument("--shard-index", type=int,
+                        help="run a single shard worker (0-based)")
+    parser.add_argument("--merge", action="store_true",
+                        help="validate all shards and merge them into the target tables")
+    parser.add_argument("--local-shards", type=int, default=0,
+                        help="run N shard workers as local processes, then merge")
+    parser.add_argument("--transform-workers", type=int,
+                        default=int(os.environ.get("ETL_TRANSFORM_WORKERS", "0")),
+                        help="transform pages in a pool of N processes (0 = in-process)")
+    args = parser.parse_args()
+
+    if args.local_shards:
+        args.shard_count = args.local_shards
+    if (args.shard_index is not None or args.merge) and args.shard_count < 1:
+        parser.error("--shard-index and --merge require --shard-count")
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be in [0, --shard-count)")
+    if args.shard_index is not None:
+        # a worker on its own runner; local shards already share one limiter state
+        rate_limiter.share_budget(args.shard_count)
+    return args
+
+
+def run_id() -> str:
+    # ties the shards of one extraction together, so a merge never picks up
+    # a staging table left behind by an older run
+    return os.environ.get("SHARD_RUN_ID", "local")
+
+
+def shard_offsets(shard_index: int, shard_count: int, limit: int):
+    page = shard_index
+    while True:
+        yield page * limit
+        page += shard_count
+
+
+def shard_table_id(table_id: str, shard_index: int) -> str:
+    return f"{table_id}{SHARD_SUFFIX}{shard_index}"
+
+
+def open_shard_file():
+    # rows are spooled to disk so a shard never holds its whole output in memory
+    return tempfile.NamedTemporaryFile("w+b", suffix=".ndjson")
+
+
+def write_rows(f, rows):
+    for row in rows:
+        f.write(json.dumps(row).encode("utf-8") + b"\n")
+
+
+def load_shard(client: bigquery.Client, dataset_id: str, table_id: str,
+               shard_index: int, shard_count: int, f, rows: int,
+               last_page: int, empty_page: int):
+    """
+    Load one shard's spooled rows into its staging table, using the target
+    table's schema, and record what the shard covered in the table description.
+    """
+    target = client.get_table(client.dataset(dataset_id).table(table_id))
+    shard_ref = client.dataset(dataset_id).table(shard_table_id(table_id, shard_index))
+
+    job_config = bigquery.LoadJobConfig(
+        schema=target.schema,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    f.seek(0)
+    client.load_table_from_file(f, shard_ref, job_config=job_config).result()
+
+    shard = client.get_table(shard_ref)
+    shard.description = json.dumps(
+        {
+            "run_id": run_id(),
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+            "rows": rows,
+            "last_page": last_page,
+            "empty_page": empty_page,
+        }
+    )
+    client.update_table(shard, ["description"])
+    print(f"Loaded shard {shard_index}/{shard_count} into {dataset_id}.{shard.table_id}, rows={rows}")
+
+
+def validate_shards(client: bigquery.Client, dataset_id: str, table_id: str, shard_count: int):
+    shards = []
+    for k in range(shard_count):
+        shard = client.get_table(client.dataset(dataset_id).table(shard_table_id(table_id, k)))
+        meta = json.loads(shard.description or "{}")
+        if meta.get("run_id") != run_id() or meta.get("shard_count") != shard_count:
+            raise RuntimeError(f"Shard {shard.table_id} does not belong to this run: {meta}")
+        if shard.num_rows != meta["rows"]:
+            raise RuntimeError(
+                f"Shard {shard.table_id} has {shard.num_rows} rows, worker reported {meta['rows']}"
+            )
+        shards.append(meta)
+
+    # every shard must have run past the last page any other shard found data on,
+    # otherwise a worker stopped early (e.g. on a transient empty response)
+    last_page = max(m["last_page"] for m in shards)
+    first_empty = min(m["empty_page"] for m in shards)
+    if first_empty <= last_page:
+        raise RuntimeError(
+            f"Shards of {table_id} are inconsistent: page {first_empty} was empty "
+            f"but page {last_page} had data"
+        )
+    return sum(m["rows"] for m in shards)
+
+
+def merge_shards(client: bigquery.Client, project_id: str, dataset_id: str, table_id: str,
+                 shard_count: int):
+    """
+    Validate all shards of a table and atomically replace the target table with
+    their union, then drop the staging tables.
+    """
+    expected_rows = validate_shards(client, dataset_id, table_id, shard_count)
+
+    union_sql = "\nUNION ALL\n".join(
+        f"SELECT * FROM `{project_id}.{dataset_id}.{shard_table_id(table_id, k)}`"
+        for k in range(shard_count)
+    )
+    job_config = bigquery.QueryJobConfig(
+        destination=f"{project_id}.{dataset_id}.{table_id}",
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    print(f"Merging {shard_count} shards into {project_id}.{dataset_id}.{table_id}")
+    client.query(union_sql, job_config=job_config).result()
+
+    merged = client.get_table(client.dataset(dataset_id).table(table_id))
+    if merged.num_rows != expected_rows:
+        raise RuntimeError(
+            f"Merged {merged.num_rows} rows into {table_id}, shards held {expected_rows}"
+        )
+
+    for k in range(shard_count):
+        client.delete_table(client.dataset(dataset_id).table(shard_table_id(table_id, k)))
+    print(f"Merged total {expected_rows} rows into {project_id}.{dataset_id}.{table_id}")
+
+
+def run_local(worker, shard_count: int, *args):
+    """
+    Run worker(shard_index, shard_count, *args) in shard_count local processes
+    and fail if any of them fails.
+    """
+    procs = [
+        multiprocessing.Process(target=worker, args=(k, shard_count, *args), name=f"shard-{k}")
+        for k in range(shard_count)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    failed = [p.name for p in procs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shard workers failed: {failed}")
@@ -1,11 +1,19 @@
 import os
 import json
-import requests
+import itertools
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import dead_letter
+import full_load
+import parallel_transform
+import rate_limiter
+import run_state
+import sharding
+
 API_BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin"
 LIMIT = 500  # page size for /promo-tracks
+JOB_NAME = "spotify_timeseries"
 
 
 def get_bq_client() -> bigquery.Client:
@@ -16,19 +24,26 @@ def get_bq_client() -> bigquery.Client:
     return bigquery.Client(project=project_id, credentials=credentials)
 
 
-def fetch_page(api_key: str, offset: int):
+def fetch_page_raw(api_key: str, offset: int) -> bytes:
     url = f"{API_BASE_URL}/promo-tracks"
     params = {"limit": LIMIT, "offset": offset}
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Accept": "application/json",
     }
-    resp = requests.get(url, params=params, headers=headers, timeout=60)
+    resp = rate_limiter.get(url, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
-    data = resp.json()
-    return data.get("data", [])
+    return resp.content
+
+
+def parse_page(raw: bytes):
+    return json.loads(raw).get("data", [])
+
+
+def fetch_page(api_key: str, offset: int):
+    return parse_page(fetch_page_raw(api_key, offset))
 
 
 def flatten_sp_json(track):
@@ -121,105 +136,236 @@ def flatten_streams_by_country(track):
     return rows
 
 
-def main():
-    project_id = os.environ["GCP_PROJECT_ID"]
+def table_ids():
+    return {
+        # timeseries table
+        "ts": (
+            os.environ.get("BQ_TS_DATASET_ID", "raw_tiktok"),
+            os.environ.get("BQ_TS_TABLE_ID", "spotify_timeseries"),
+        ),
+        # source-of-streams table
+        "src": (
+            os.environ.get("BQ_SRC_DATASET_ID", "raw_tiktok"),
+            os.environ.get("BQ_SRC_TABLE_ID", "spotify_source_streams"),
+        ),
+        # streams-by-country table
+        "ctry": (
+            os.environ.get("BQ_CTRY_DATASET_ID", "raw_tiktok"),
+            os.environ.get("BQ_CTRY_TABLE_ID", "spotify_streams_by_country"),
+        ),
+    }
 
-    # timeseries table
-    ts_dataset_id = os.environ.get("BQ_TS_DATASET_ID", "raw_tiktok")
-    ts_table_id = os.environ.get("BQ_TS_TABLE_ID", "spotify_timeseries")
 
-    # source-of-streams table
-    src_dataset_id = os.environ.get("BQ_SRC_DATASET_ID", "raw_tiktok")
-    src_table_id = os.environ.get("BQ_SRC_TABLE_ID", "spotify_source_streams")
+# table -> mapper producing its rows from one track
+MAPPERS = {
+    "ts": flatten_sp_json,
+    "src": flatten_source_of_streams,
+    "ctry": flatten_streams_by_country,
+}
 
-    # streams-by-country table
-    ctry_dataset_id = os.environ.get("BQ_CTRY_DATASET_ID", "raw_tiktok")
-    ctry_table_id = os.environ.get("BQ_CTRY_TABLE_ID", "spotify_streams_by_country")
+# table -> (key of its rows, track field), for the dead-letter quarantine
+KEYS = {
+    "ts": (("isrc", "date"), "isrc"),
+    "src": ("isrc", "isrc"),
+    "ctry": (("isrc", "name"), "isrc"),
+}
 
-    api_key = os.environ["API_KEY"]
 
-    client = get_bq_client()
-    ts_table_ref = client.dataset(ts_dataset_id).table(ts_table_id)
-    src_table_ref = client.dataset(src_dataset_id).table(src_table_id)
-    ctry_table_ref = client.dataset(ctry_dataset_id).table(ctry_table_id)
+def dead_letter_keys():
+    tables = table_ids()
+    return {".".join(tables[name]): key for name, key in KEYS.items()}
+
+
+def flatten_page(tracks):
+    """
+    Rows for all three tables from one page of promo-tracks:
+    ({"ts": [...], "src": [...], "ctry": [...]}, failures)
+    A track whose mapper raises is left out of that table and reported in
+    failures as (table, mapper, track, reason) for the dead-letter quarantine.
+    """
+    tables = table_ids()
+    page_rows = {name: [] for name in MAPPERS}
+    failures = []
+    for track in tracks:
+        if not track.get("isrc") or not track.get("sp_json"):
+            continue
+
+        for name, mapper in MAPPERS.items():
+            try:
+                page_rows[name].extend(dead_letter.apply(mapper, track))
+            except Exception as e:
+                failures.append((".".join(tables[name]), dead_letter.mapper_name(mapper), track, repr(e)))
+    return page_rows, failures
+
+
+def transform_raw_page(raw: bytes):
+    """
+    Worker-side transform for the process pool: decode one raw page and
+    return (item_count, {table: columns}, failures).
+    """
+    tracks = parse_page(raw)
+    page_rows, failures = flatten_page(tracks)
+    columns = {name: parallel_transform.to_columns(rows) for name, rows in page_rows.items()}
+    return len(tracks), columns, failures
 
-    # *** Overwrite: clear tables before inserting this run ***
-    truncate_ts_sql = f"TRUNCATE TABLE `{project_id}.{ts_dataset_id}.{ts_table_id}`"
-    truncate_src_sql = f"TRUNCATE TABLE `{project_id}.{src_dataset_id}.{src_table_id}`"
-    truncate_ctry_sql = f"TRUNCATE TABLE `{project_id}.{ctry_dataset_id}.{ctry_table_id}`"
 
-    print(f"Running: {truncate_ts_sql}")
-    client.query(truncate_ts_sql).result()
-    print("Timeseries table truncated before load")
+def iter_pages(api_key: str, offsets, workers: int):
+    """
+    Yield (offset, raw, item_count, page_rows, failures) in offset order until
+    the first empty page, raw being the page body in both the serial and the
+    pool mode.
+    """
+    if not workers:
+        for offset in offsets:
+            raw = fetch_page_raw(api_key, offset)
+            tracks = parse_page(raw)
+            if not tracks:
+                return
+            yield (offset, raw, len(tracks), *flatten_page(tracks))
+        return
+
+    pages = parallel_transform.imap_pages(
+        lambda offset: fetch_page_raw(api_key, offset), transform_raw_page, offsets, workers
+    )
+    for offset, raw, (item_count, columns, failures) in pages:
+        page_rows = {name: parallel_transform.from_columns(c) for name, c in columns.items()}
+        yield offset, raw, item_count, page_rows, failures
+
 
-    print(f"Running: {truncate_src_sql}")
-    client.query(truncate_src_sql).result()
-    print("Source-of-streams table truncated before load")
+def run_full(workers: int = 0):
+    project_id = os.environ["GCP_PROJECT_ID"]
+    tables = table_ids()
+    ts_dataset_id, ts_table_id = tables["ts"]
+    src_dataset_id, src_table_id = tables["src"]
+    ctry_dataset_id, ctry_table_id = tables["ctry"]
 
-    print(f"Running: {truncate_ctry_sql}")
-    client.query(truncate_ctry_sql).result()
-    print("Streams-by-country table truncated before load")
+    api_key = os.environ["API_KEY"]
 
-    offset = 0
-    total_ts_rows = 0
-    total_src_rows = 0
-    total_ctry_rows = 0
+    client = get_bq_client()
+    ts_table_ref = client.dataset(ts_dataset_id).table(ts_table_id)
+    src_table_ref = client.dataset(src_dataset_id).table(src_table_id)
+    ctry_table_ref = client.dataset(ctry_dataset_id).table(ctry_table_id)
 
-    while True:
-        tracks = fetch_page(api_key, offset)
-        if not tracks:
-            break
+    run = run_state.begin(JOB_NAME)
+    dlq = dead_letter.DeadLetter(JOB_NAME, client, project_id, run, keys=dead_letter_keys())
+    # *** Overwrite: the run fills staging tables, published over the tables at the end ***
+    ts_staging_ref = full_load.staging_table(client, run, ts_table_ref)
+    src_staging_ref = full_load.staging_table(client, run, src_table_ref)
+    ctry_staging_ref = full_load.staging_table(client, run, ctry_table_ref)
 
-        ts_rows_to_insert = []
-        src_rows_to_insert = []
-        ctry_rows_to_insert = []
+    offset = run["offset"]
+    # the totals travel in the checkpoint so a resumed run reports the whole load
+    totals = run.setdefault("totals", {"ts": 0, "src": 0, "ctry": 0})
 
-        for track in tracks:
-            if not track.get("isrc") or not track.get("sp_json"):
-                continue
+    offsets = itertools.count(offset, LIMIT)
+    for offset, raw, item_count, page_rows, failures in iter_pages(api_key, offsets, workers):
+        dlq.map_failures(failures)
+        # rejected rows are traced back to their track only if there are any
+        source_of = dead_letter.by_key(lambda: parse_page(raw), "isrc")
 
-            ts_rows_to_insert.extend(flatten_sp_json(track))
-            src_rows_to_insert.append(flatten_source_of_streams(track))
-            ctry_rows_to_insert.extend(flatten_streams_by_country(track))
+        ts_rows_to_insert = page_rows["ts"]
+        src_rows_to_insert = page_rows["src"]
+        ctry_rows_to_insert = page_rows["ctry"]
 
         if ts_rows_to_insert:
-            ts_errors = client.insert_rows_json(ts_table_ref, ts_rows_to_insert)
-            if ts_errors:
-                raise RuntimeError(f"BigQuery TS insert errors: {ts_errors}")
-            batch_ts = len(ts_rows_to_insert)
-            total_ts_rows += batch_ts
+            inserted = dlq.insert(ts_table_ref, ts_rows_to_insert, flatten_sp_json, source_of, into=ts_staging_ref)
+            batch_ts = len(inserted)
+            totals["ts"] += batch_ts
             print(f"Inserted TS batch at offset={offset}, rows={batch_ts}")
 
         if src_rows_to_insert:
-            src_errors = client.insert_rows_json(src_table_ref, src_rows_to_insert)
-            if src_errors:
-                raise RuntimeError(f"BigQuery SRC insert errors: {src_errors}")
-            batch_src = len(src_rows_to_insert)
-            total_src_rows += batch_src
+            inserted = dlq.insert(
+                src_table_ref, src_rows_to_insert, flatten_source_of_streams, source_of, into=src_staging_ref
+            )
+            batch_src = len(inserted)
+            totals["src"] += batch_src
             print(f"Inserted SRC batch at offset={offset}, rows={batch_src}")
 
         if ctry_rows_to_insert:
-            ctry_errors = client.insert_rows_json(ctry_table_ref, ctry_rows_to_insert)
-            if ctry_errors:
-                raise RuntimeError(f"BigQuery CTRY insert errors: {ctry_errors}")
-            batch_ctry = len(ctry_rows_to_insert)
-            total_ctry_rows += batch_ctry
+            inserted = dlq.insert(
+                ctry_table_ref, ctry_rows_to_insert, flatten_streams_by_country, source_of, into=ctry_staging_ref
+            )
+            batch_ctry = len(inserted)
+            totals["ctry"] += batch_ctry
             print(f"Inserted CTRY batch at offset={offset}, rows={batch_ctry}")
 
-        offset += LIMIT
+        if run_state.page_done(JOB_NAME, run, offset + LIMIT, raw, item_count):
+            dlq.flush()
+            return
 
     print(
-        f"Inserted total {total_ts_rows} timeseries rows into "
+        f"Inserted total {totals['ts']} timeseries rows into "
         f"{project_id}.{ts_dataset_id}.{ts_table_id}"
     )
     print(
-        f"Inserted total {total_src_rows} source-of-streams rows into "
+        f"Inserted total {totals['src']} source-of-streams rows into "
         f"{project_id}.{src_dataset_id}.{src_table_id}"
     )
     print(
-        f"Inserted total {total_ctry_rows} streams-by-country rows into "
+        f"Inserted total {totals['ctry']} streams-by-country rows into "
         f"{project_id}.{ctry_dataset_id}.{ctry_table_id}"
     )
+    dlq.finish()
+    full_load.publish(client, project_id, ts_table_ref, ts_staging_ref)
+    full_load.publish(client, project_id, src_table_ref, src_staging_ref)
+    full_load.publish(client, project_id, ctry_table_ref, ctry_staging_ref)
+    run_state.finish(JOB_NAME, run)
+
+
+def run_shard(shard_index: int, shard_count: int, workers: int = 0):
+    api_key = os.environ["API_KEY"]
+    client = get_bq_client()
+    tables = table_ids()
+
+    dlq = dead_letter.DeadLetter(JOB_NAME, client, os.environ.get("GCP_PROJECT_ID"), keys=dead_letter_keys())
+
+    files = {name: sharding.open_shard_file() for name in tables}
+    totals = {name: 0 for name in tables}
+    last_page = -1
+
+    offsets = sharding.shard_offsets(shard_index, shard_count, LIMIT)
+    for offset, _, _, page_rows, failures in iter_pages(api_key, offsets, workers):
+        last_page = offset // LIMIT
+        dlq.map_failures(failures)
+
+        for name, rows in page_rows.items():
+            sharding.write_rows(files[name], rows)
+            totals[name] += len(rows)
+            dlq.count(len(rows))
+
+    # the page after this shard's last one in its stride came back empty
+    empty_page = last_page + shard_count if last_page >= 0 else shard_index
+    # a shard over the error rate fails here, so the merge never sees it
+    dlq.finish()
+
+    for name, (dataset_id, table_id) in tables.items():
+        sharding.load_shard(
+            client, dataset_id, table_id, shard_index, shard_count,
+            files[name], totals[name], last_page, empty_page,
+        )
+        files[name].close()
+
+
+def run_merge(shard_count: int):
+    project_id = os.environ["GCP_PROJECT_ID"]
+    client = get_bq_client()
+    for dataset_id, table_id in table_ids().values():
+        sharding.merge_shards(client, project_id, dataset_id, table_id, shard_count)
+
+
+def main():
+    if run_state.push_fed(JOB_NAME):
+        return
+    args = sharding.parse_args("Load Spotify data from /promo-tracks into BigQuery")
+    if args.local_shards:
+        sharding.run_local(run_shard, args.local_shards, args.transform_workers)
+        run_merge(args.local_shards)
+    elif args.shard_index is not None:
+        run_shard(args.shard_index, args.shard_count, args.transform_workers)
+    elif args.merge:
+        run_merge(args.shard_count)
+    else:
+        run_full(args.transform_workers)
 
 
 if __name__ == "__main__":
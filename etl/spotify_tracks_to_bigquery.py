@@ -1,11 +1,20 @@
 import os
 import json
-import requests
+import itertools
+import tempfile
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import bq_upsert
+import dead_letter
+import full_load
+import page_cache
+import rate_limiter
+import run_state
+
 API_BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin"
 LIMIT = 500  # or 100 if that’s the max for this endpoint
+JOB_NAME = "spotify_tracks"
 
 
 def get_bq_client() -> bigquery.Client:
@@ -16,7 +25,7 @@ def get_bq_client() -> bigquery.Client:
     return bigquery.Client(project=project_id, credentials=credentials)
 
 
-def fetch_page(api_key: str, offset: int):
+def fetch_page_response(api_key: str, offset: int, conditional: dict = None):
     url = f"{API_BASE_URL}/promo-tracks"
     params = {
         "limit": LIMIT,
@@ -25,91 +34,176 @@ def fetch_page(api_key: str, offset: int):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Accept": "application/json",
+        **(conditional or {}),
     }
-    resp = requests.get(url, params=params, headers=headers, timeout=60)
+    resp = rate_limiter.get(url, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
+    return resp
+
+
+def parse_page(resp):
     data = resp.json()
     # expected shape: { "success": true, "data": [...] }
     return data.get("data", [])
 
 
+def to_bq_row(x):
+    return {
+        "id": x["id"],
+        "track_title": x.get("track_title"),
+        "artist_name": x.get("artist_name"),
+        "isrc": x.get("isrc"),
+        "total_views": x.get("total_views"),
+        "total_likes": x.get("total_likes"),
+        "total_comments": x.get("total_comments"),
+        "total_shares": x.get("total_shares"),
+        "sp_streams_total": x.get("sp_streams_total"),
+        "sp_listeners_total": x.get("sp_listeners_total"),
+        "sp_streams_per_listener_total": x.get("sp_streams_per_listener_total"),
+        "sp_playlist_adds_total": x.get("sp_playlist_adds_total"),
+        "sp_saves_total": x.get("sp_saves_total"),
+        "sp_user_total": x.get("sp_user_total"),
+        "sp_network_total": x.get("sp_network_total"),
+        "sp_catalog_total": x.get("sp_catalog_total"),
+        "sp_other_total": x.get("sp_other_total"),
+        "sp_personalized_total": x.get("sp_personalized_total"),
+        "sp_editorial_total": x.get("sp_editorial_total"),
+        "sp_updated_at": x.get("sp_updated_at"),
+        "sp_last_day_streams": x.get("sp_last_day_streams"),
+        "sp_last_day_listeners": x.get("sp_last_day_listeners"),
+        "sp_last_day_streams_per_listener": x.get("sp_last_day_streams_per_listener"),
+        "sp_last_day_playlist_adds_total": x.get("sp_last_day_playlist_adds_total"),
+        "sp_release_date": x.get("sp_release_date"),
+        "sp_total_stream_count": x.get("sp_total_stream_count"),
+        "upc": x.get("upc"),
+        "last_parse_status": x.get("last_parse_status"),
+        "last_parse_attempt_at": x.get("last_parse_attempt_at"),
+        "last_parse_error": x.get("last_parse_error"),
+        # explicitly NOT including updated_at or sp_json
+    }
+
+
 def to_bq_rows(items):
-    rows = []
-    for x in items:
-        rows.append(
-            {
-                "id": x["id"],
-                "track_title": x.get("track_title"),
-                "artist_name": x.get("artist_name"),
-                "isrc": x.get("isrc"),
-                "total_views": x.get("total_views"),
-                "total_likes": x.get("total_likes"),
-                "total_comments": x.get("total_comments"),
-                "total_shares": x.get("total_shares"),
-                "sp_streams_total": x.get("sp_streams_total"),
-                "sp_listeners_total": x.get("sp_listeners_total"),
-                "sp_streams_per_listener_total": x.get("sp_streams_per_listener_total"),
-                "sp_playlist_adds_total": x.get("sp_playlist_adds_total"),
-                "sp_saves_total": x.get("sp_saves_total"),
-                "sp_user_total": x.get("sp_user_total"),
-                "sp_network_total": x.get("sp_network_total"),
-                "sp_catalog_total": x.get("sp_catalog_total"),
-                "sp_other_total": x.get("sp_other_total"),
-                "sp_personalized_total": x.get("sp_personalized_total"),
-                "sp_editorial_total": x.get("sp_editorial_total"),
-                "sp_updated_at": x.get("sp_updated_at"),
-                "sp_last_day_streams": x.get("sp_last_day_streams"),
-                "sp_last_day_listeners": x.get("sp_last_day_listeners"),
-                "sp_last_day_streams_per_listener": x.get("sp_last_day_streams_per_listener"),
-                "sp_last_day_playlist_adds_total": x.get("sp_last_day_playlist_adds_total"),
-                "sp_release_date": x.get("sp_release_date"),
-                "sp_total_stream_count": x.get("sp_total_stream_count"),
-                "upc": x.get("upc"),
-                "last_parse_status": x.get("last_parse_status"),
-                "last_parse_attempt_at": x.get("last_parse_attempt_at"),
-                "last_parse_error": x.get("last_parse_error"),
-                # explicitly NOT including updated_at or sp_json
-            }
-        )
-    return rows
+    return [to_bq_row(x) for x in items]
+
+
+def load_changed_pages(client: bigquery.Client, project_id: str, dataset_id: str, table_id: str,
+                       api_key: str, cache: page_cache.PageCache, dlq: dead_letter.DeadLetter, run: dict):
+    """
+    Incremental run against the page cache of the last load: only pages that
+    changed are decoded, and their rows replace the old ones by id. Rows of
+    pages that vanished are deleted; nothing is written if no page changed.
+    Returns False, without fetching anything, while the table has a streaming
+    buffer: the caller then reloads it in full.
+    """
+    table_ref = client.dataset(dataset_id).table(table_id)
+    table = client.get_table(table_ref)
+    if table.streaming_buffer is not None:
+        print(f"{project_id}.{dataset_id}.{table_id} has rows in its streaming buffer, loading it in full")
+        return False
+    schema = table.schema
+    f = tempfile.NamedTemporaryFile("w+b", suffix=".ndjson")
+    total_rows = 0
+
+    for offset in itertools.count(0, LIMIT):
+        resp = fetch_page_response(api_key, offset, cache.validators(offset))
+        if cache.unchanged(offset, resp):
+            continue
+        items = parse_page(resp)
+        if not items:
+            break
+
+        rows = dlq.map(table_ref, to_bq_row, items)
+        dlq.count(len(rows))
+        # a row the staging load would reject is quarantined instead of failing the load
+        rows = dlq.validate(table_ref, schema, rows, to_bq_row, dead_letter.by_key(lambda: items, "id"))
+        for row in rows:
+            f.write(json.dumps(row).encode("utf-8") + b"\n")
+        total_rows += len(rows)
+        cache.page_loaded(offset, [x.get("id") for x in items], complete=len(rows) == len(items))
+        print(f"Changed page at offset={offset}, rows={len(rows)}")
+
+    if cache.all_unchanged():
+        print(f"No page changed, keeping {project_id}.{dataset_id}.{table_id} as is")
+    else:
+        try:
+            bq_upsert.replace_by_key_from_file(
+                client, project_id, dataset_id, table_id, "id", cache.stale_keys(), f, total_rows
+            )
+        except Exception:
+            # the table may no longer match the cache: reload it in full next run
+            cache.clear()
+            raise
+        print(f"Replaced {total_rows} changed rows in {project_id}.{dataset_id}.{table_id}")
+    f.close()
+
+    cache.save()
+    run["rows"] = cache.row_count()
+    run["digest"] = cache.digest()
+    return True
 
 
 def main():
+    if run_state.push_fed(JOB_NAME):
+        return
     project_id = os.environ["GCP_PROJECT_ID"]
-    dataset_id = "raw_tiktok"
-    table_id = "spotify_tracks"
+    dataset_id = os.environ.get("BQ_SPOTIFY_TRACKS_DATASET_ID", "raw_tiktok")
+    table_id = os.environ.get("BQ_SPOTIFY_TRACKS_TABLE_ID", "spotify_tracks")
     api_key = os.environ["API_KEY"]
 
     client = get_bq_client()
     table_ref = client.dataset(dataset_id).table(table_id)
 
-    # *** Overwrite: clear table before inserting this run ***
-    truncate_sql = f"TRUNCATE TABLE `{project_id}.{dataset_id}.{table_id}`"
-    print(f"Running: {truncate_sql}")
-    client.query(truncate_sql).result()
-    print("Table truncated before load")
-
-    offset = 0
-    total_rows = 0
+    run = run_state.begin(JOB_NAME)
+    dlq = dead_letter.DeadLetter(
+        JOB_NAME, client, project_id, run, keys={dead_letter.table_name(table_ref): ("id", "id")}
+    )
+    cache = page_cache.PageCache(JOB_NAME)
+    if cache.primed and not run["resumed"]:
+        if load_changed_pages(client, project_id, dataset_id, table_id, api_key, cache, dlq, run):
+            dlq.finish()
+            run_state.finish(JOB_NAME, run)
+            return
+
+    if not run["resumed"]:
+        # the cache describes the table as this load leaves it, once published
+        cache.clear()
+    # *** Overwrite: the run fills a staging table, published over the table at the end ***
+    staging_ref = full_load.staging_table(client, run, table_ref)
+    # the full load rebuilds the page cache as it goes
+    cache.track(run)
+
+    offset = run["offset"]
+    total_rows = run["rows"]
 
     while True:
-        items = fetch_page(api_key, offset)
+        resp = fetch_page_response(api_key, offset)
+        cache.record(offset, resp)
+        items = parse_page(resp)
         if not items:
             break
 
-        rows = to_bq_rows(items)
-        errors = client.insert_rows_json(table_ref, rows)
-        if errors:
-            raise RuntimeError(f"BigQuery insert errors: {errors}")
+        rows = dlq.map(table_ref, to_bq_row, items)
+        inserted = dlq.insert(table_ref, rows, to_bq_row, dead_letter.by_key(lambda: items, "id"), into=staging_ref)
+        cache.page_loaded(offset, [x.get("id") for x in items], complete=len(inserted) == len(items))
 
-        batch_count = len(rows)
+        batch_count = len(inserted)
         total_rows += batch_count
         print(f"Inserted batch at offset={offset}, rows={batch_count}")
         offset += LIMIT
 
+        if run_state.page_done(JOB_NAME, run, offset, items, batch_count):
+            dlq.flush()
+            return
+
     print(f"Inserted total {total_rows} rows into {project_id}.{dataset_id}.{table_id}")
+    dlq.finish()
+    full_load.publish(client, project_id, table_ref, staging_ref)
+    cache.save()
+    run["digest"] = cache.digest()
+    run_state.finish(JOB_NAME, run)
 
 
 if __name__ == "__main__":
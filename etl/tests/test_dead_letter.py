@@ -0,0 +1,49 @@
+from argparse import Namespace
+from types import SimpleNamespace
+from unittest import mock
+
+import dead_letter
+
+
+def quarantined(tmp_path, monkeypatch):
+    monkeypatch.setattr(dead_letter, "DEAD_LETTER_DIR", str(tmp_path))
+    dlq = dead_letter.DeadLetter("payment_operations", keys={"raw_tiktok.payment_operations": ("id", "id")})
+    dlq.quarantine("insert", "raw_tiktok.payment_operations", "payment_operations_to_bigquery:to_row",
+                   {"id": 1}, "invalid", {"id": "1", "usd_value": 2.0})
+    return dead_letter.read_local("payment_operations")
+
+
+def replay(client):
+    args = Namespace(job="payment_operations", source="local", dry_run=False)
+    with mock.patch.object(dead_letter, "get_bq_client", return_value=client):
+        dead_letter.replay(args)
+
+
+def client_with(streaming_buffer):
+    client = mock.MagicMock()
+    client.get_table.return_value = SimpleNamespace(schema=[], streaming_buffer=streaming_buffer)
+    return client
+
+
+def test_replay_keeps_entries_while_the_table_has_a_streaming_buffer(tmp_path, monkeypatch):
+    entries = quarantined(tmp_path, monkeypatch)
+    client = client_with(streaming_buffer=SimpleNamespace(estimated_rows=10))
+
+    replay(client)
+
+    client.load_table_from_json.assert_not_called()
+    client.query.assert_not_called()
+    assert dead_letter.read_local("payment_operations") == entries
+
+
+def test_replay_replaces_by_key_and_drops_replayed_entries(tmp_path, monkeypatch):
+    quarantined(tmp_path, monkeypatch)
+    client = client_with(streaming_buffer=None)
+
+    replay(client)
+
+    rows = client.load_table_from_json.call_args[0][0]
+    assert rows == [{"id": "1", "usd_value": 2.0}]
+    sql = client.query.call_args[0][0]
+    assert "DELETE FROM" in sql and "INSERT INTO" in sql
+    assert dead_letter.read_local("payment_operations") == []
@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import bq_upsert
+import dead_letter
+import ingest_service
+
+
+def operation(id, profile_id, usd_value, **fields):
+    return dict({
+        "id": id, "profile_id": profile_id, "profile_name": f"name {profile_id}",
+        "telegram_manager_id": "m1", "manager_id": "m1", "promo_platform": "tiktok", "status": "paid",
+        "promotional_quantities": 1, "usd_value": usd_value, "payment_date": "2026-01-01",
+    }, **fields)
+
+
+class FakeBigQuery:
+    """payment_operations and its rollup in memory, written through replace_by_key."""
+
+    def __init__(self, operations):
+        self.tables = {"payment_operations": list(operations), "payment_operations_rollup": []}
+        self.client = mock.MagicMock()
+        self.client.query.side_effect = self.query
+
+    def replace_by_key(self, client, project_id, dataset_id, table_id, key, keys, rows):
+        keys = {str(k) for k in keys if k is not None}
+        kept = [r for r in self.tables[table_id] if bq_upsert.key_of(r, key) not in keys]
+        self.tables[table_id] = kept + list(rows)
+        return len(rows)
+
+    def query(self, sql, job_config=None):
+        values = set(job_config.query_parameters[0].values)
+        operations = self.tables["payment_operations"]
+        if "SELECT DISTINCT" in sql:
+            result = [
+                {"profile_key": bq_upsert.key_of(r, ("profile_id",))}
+                for r in operations if str(r["id"]) in values
+            ]
+        else:
+            result = [r for r in operations if bq_upsert.key_of(r, ("profile_id",)) in values]
+        return SimpleNamespace(result=lambda: result)
+
+    def rollup(self):
+        return {
+            r["profile_id"]: (r["operations_count"], r["usd_value"])
+            for r in self.tables["payment_operations_rollup"]
+        }
+
+
+def test_pushed_payment_operation_refreshes_the_rollup(tmp_path, monkeypatch):
+    monkeypatch.setattr(dead_letter, "DEAD_LETTER_DIR", str(tmp_path))
+    bq = FakeBigQuery([operation("1", "p1", 10.0), operation("2", "p1", 5.0), operation("3", "p3", 1.0)])
+    config = ingest_service.entities()
+    flush = ingest_service.make_flush(bq.client, "project", config, dead_letter.DeadLetter("ingest_service"))
+
+    with mock.patch.object(bq_upsert, "replace_by_key", side_effect=bq.replace_by_key):
+        # operation 1 moves from profile p1 to p2, operation 4 is new
+        flush("payment_operations", [
+            ("updated", operation("1", "p2", 7.0)),
+            ("created", operation("4", "p2", 2.0)),
+        ])
+
+    assert bq.rollup() == {"p1": (1, 5.0), "p2": (2, 9.0)}
+
+
+def test_failed_rollup_refresh_is_retried_with_the_next_flush(tmp_path, monkeypatch):
+    monkeypatch.setattr(dead_letter, "DEAD_LETTER_DIR", str(tmp_path))
+    bq = FakeBigQuery([operation("1", "p1", 10.0)])
+    config = ingest_service.entities()
+    flush = ingest_service.make_flush(bq.client, "project", config, dead_letter.DeadLetter("ingest_service"))
+
+    def fail_on_rollup(client, project_id, dataset_id, table_id, *args):
+        if table_id == "payment_operations_rollup":
+            raise RuntimeError("rollup unavailable")
+        return bq.replace_by_key(client, project_id, dataset_id, table_id, *args)
+
+    with mock.patch.object(bq_upsert, "replace_by_key", side_effect=fail_on_rollup):
+        flush("payment_operations", [("updated", operation("1", "p2", 7.0))])
+    assert bq.rollup() == {}
+
+    with mock.patch.object(bq_upsert, "replace_by_key", side_effect=bq.replace_by_key):
+        flush("payment_operations", [("created", operation("5", "p5", 3.0))])
+
+    # p1 lost its only operation, so it has no rollup row left
+    assert bq.rollup() == {"p2": (1, 7.0), "p5": (1, 3.0)}
+
+
+def test_non_integral_quantity_is_quarantined_not_rounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(dead_letter, "DEAD_LETTER_DIR", str(tmp_path))
+    bq = FakeBigQuery([operation("1", "p1", 10.0)])
+    config = ingest_service.entities()
+    flush = ingest_service.make_flush(bq.client, "project", config, dead_letter.DeadLetter("ingest_service"))
+
+    with mock.patch.object(bq_upsert, "replace_by_key", side_effect=bq.replace_by_key):
+        flush("payment_operations", [
+            ("updated", operation("1", "p1", 10.0, promotional_quantities="2.5")),
+            ("created", operation("2", "p1", 5.0, promotional_quantities="3")),
+        ])
+
+    assert [r["id"] for r in bq.tables["payment_operations"]] == ["1", "2"]
+    assert bq.tables["payment_operations"][0]["promotional_quantities"] == 1
+    [rollup] = bq.tables["payment_operations_rollup"]
+    assert (rollup["operations_count"], rollup["promotional_quantities"]) == (2, 4)
+    [entry] = dead_letter.read_local("ingest_service")
+    assert entry["stage"] == "map" and "non-integral" in entry["reason"]
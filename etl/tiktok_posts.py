@@ -0,0 +1,340 @@
+import os
+import json
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+from google.cloud import bigquery
+
+import bq_upsert
+import dead_letter
+
+# TikTok post payload (json_data of a promo expense) shredded into typed
+# tables once, at ingestion: one row per post in tiktok_posts, one row per
+# hashtag in tiktok_post_hashtags. Column names and conversions match what
+# promo_expenses_parsed / promo_expenses_hashtags used to compute with JSON_VALUE.
+# Those models read json_data from the promo_expenses table, not from the
+# /promo-expenses API that promo_exp_to_bigquery.py loads; a record the API
+# sends without json_data gets it from that table (with_payloads).
+
+PAYLOAD_TABLE = os.environ.get("BQ_PROMO_EXPENSES_TABLE", "raw_data.promo_expenses")  # dataset.table
+
+POSTS_SCHEMA = [
+    bigquery.SchemaField("post_id", "STRING"),
+    bigquery.SchemaField("text", "STRING"),
+    bigquery.SchemaField("text_language", "STRING"),
+    bigquery.SchemaField("create_time_ts", "TIMESTAMP"),
+    bigquery.SchemaField("create_time_iso", "STRING"),
+    bigquery.SchemaField("location_created", "STRING"),
+    bigquery.SchemaField("is_ad", "BOOL"),
+    bigquery.SchemaField("author_id", "STRING"),
+    bigquery.SchemaField("author_name", "STRING"),
+    bigquery.SchemaField("author_profile_url", "STRING"),
+    bigquery.SchemaField("author_nick", "STRING"),
+    bigquery.SchemaField("author_verified", "BOOL"),
+    bigquery.SchemaField("author_signature", "STRING"),
+    bigquery.SchemaField("author_following", "INT64"),
+    bigquery.SchemaField("author_friends", "INT64"),
+    bigquery.SchemaField("author_fans", "INT64"),
+    bigquery.SchemaField("author_hearts", "INT64"),
+    bigquery.SchemaField("author_videos", "INT64"),
+    bigquery.SchemaField("music_id", "STRING"),
+    bigquery.SchemaField("music_name", "STRING"),
+    bigquery.SchemaField("music_author", "STRING"),
+    bigquery.SchemaField("video_height", "INT64"),
+    bigquery.SchemaField("video_width", "INT64"),
+    bigquery.SchemaField("video_duration", "INT64"),
+    bigquery.SchemaField("digg_count", "INT64"),
+    bigquery.SchemaField("share_count", "INT64"),
+    bigquery.SchemaField("play_count", "INT64"),
+    bigquery.SchemaField("collect_count", "INT64"),
+    bigquery.SchemaField("comment_count", "INT64"),
+    bigquery.SchemaField("json_hash", "STRING"),  # sha256 of the payload, for incremental loads
+]
+
+HASHTAGS_SCHEMA = [
+    bigquery.SchemaField("post_id", "STRING"),
+    bigquery.SchemaField("hashtag_index", "INT64"),
+    bigquery.SchemaField("hashtag_id", "STRING"),
+    bigquery.SchemaField("hashtag_name", "STRING"),
+]
+
+
+def table_ids():
+    dataset_id = os.environ.get("BQ_POSTS_DATASET_ID", "raw_tiktok")
+    return {
+        "posts": (dataset_id, os.environ.get("BQ_POSTS_TABLE_ID", "tiktok_posts")),
+        "hashtags": (dataset_id, os.environ.get("BQ_POST_HASHTAGS_TABLE_ID", "tiktok_post_hashtags")),
+    }
+
+
+def parse_post(record: dict):
+    """The TikTok post of a promo expense record, or None if it has none."""
+    post = record.get("json_data")
+    if isinstance(post, str):
+        post = json.loads(post) if post.strip() else None
+    return post if isinstance(post, dict) else None
+
+
+def with_payloads(client: bigquery.Client, project_id: str, records):
+    """
+    The records, each with its json_data: records that came without the field
+    get the one PAYLOAD_TABLE holds for their id. Live records left without a
+    payload are logged, since their posts can't be loaded or referenced.
+    """
+    missing = {
+        str(r["id"]) for r in records
+        if "json_data" not in r and r.get("id") is not None and not to_bool(r.get("deleted"))
+    }
+    payloads = {}
+    if missing:
+        sql = f"""
+        SELECT CAST(id AS STRING) AS id, json_data
+        FROM `{project_id}.{PAYLOAD_TABLE}`
+        WHERE CAST(id AS STRING) IN UNNEST(@ids)
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", sorted(missing))]
+        )
+        payloads = {r["id"]: r["json_data"] for r in client.query(sql, job_config=job_config).result()}
+        print(f"{len(missing)} promo expenses came without json_data, {len(payloads)} read from {PAYLOAD_TABLE}")
+        records = [
+            dict(r, json_data=payloads.get(str(r["id"]))) if str(r.get("id")) in missing else r for r in records
+        ]
+    without = [r.get("id") for r in records if not to_bool(r.get("deleted")) and r.get("json_data") is None]
+    if without:
+        print(f"WARNING: {len(without)} of {len(records)} promo expenses have no json_data, "
+              f"their posts are not loaded (first ids: {without[:10]})")
+    return records
+
+
+def json_value(v):
+    # JSON_VALUE semantics: scalars as strings, objects and arrays as NULL
+    if v is None or isinstance(v, (dict, list)):
+        return None
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    return str(v)
+
+
+def to_int(v):
+    return int(v) if v not in (None, "") else None
+
+
+def to_bool(v):
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.lower() in ("true", "false"):
+        return v.lower() == "true"
+    return None
+
+
+def post_id(record: dict):
+    post = parse_post(record)
+    return json_value(post.get("id")) if post else None
+
+
+def live_post_ids(records):
+    """Post ids of the records that are not soft-deleted, for the page cache's refs."""
+    ids = []
+    for record in records:
+        if to_bool(record.get("deleted")):
+            continue
+        try:
+            ids.append(post_id(record))
+        except ValueError:
+            pass  # unparseable json_data: no post to point to
+    return ids
+
+
+def post_hash(post: dict) -> str:
+    return hashlib.sha256(json.dumps(post, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def post_rows(record: dict):
+    """tiktok_posts row of a promo expense record ([] without a post)."""
+    post = parse_post(record)
+    if not post or json_value(post.get("id")) is None:
+        return []
+    author = post.get("authorMeta") or {}
+    music = post.get("musicMeta") or {}
+    video = post.get("videoMeta") or {}
+    create_time = to_int(post.get("createTime"))
+    return [{
+        "post_id": json_value(post.get("id")),
+        "text": json_value(post.get("text")),
+        "text_language": json_value(post.get("textLanguage")),
+        # createTime is read as milliseconds, like timestamp_millis() in the old model
+        "create_time_ts": (
+            datetime.fromtimestamp(create_time / 1000, tz=timezone.utc).isoformat()
+            if create_time is not None else None
+        ),
+        "create_time_iso": json_value(post.get("createTimeISO")),
+        "location_created": json_value(post.get("locationCreated")),
+        "is_ad": to_bool(post.get("isAd")),
+        "author_id": json_value(author.get("id")),
+        "author_name": json_value(author.get("name")),
+        "author_profile_url": json_value(author.get("profileUrl")),
+        "author_nick": json_value(author.get("nickName")),
+        "author_verified": to_bool(author.get("verified")),
+        "author_signature": json_value(author.get("signature")),
+        "author_following": to_int(author.get("following")),
+        "author_friends": to_int(author.get("friends")),
+        "author_fans": to_int(author.get("fans")),
+        "author_hearts": to_int(author.get("heart")),
+        "author_videos": to_int(author.get("video")),
+        "music_id": json_value(music.get("musicId")),
+        "music_name": json_value(music.get("musicName")),
+        "music_author": json_value(music.get("musicAuthor")),
+        "video_height": to_int(video.get("height")),
+        "video_width": to_int(video.get("width")),
+        "video_duration": to_int(video.get("duration")),
+        "digg_count": to_int(post.get("diggCount")),
+        "share_count": to_int(post.get("shareCount")),
+        "play_count": to_int(post.get("playCount")),
+        "collect_count": to_int(post.get("collectCount")),
+        "comment_count": to_int(post.get("commentCount")),
+        "json_hash": post_hash(post),
+    }]
+
+
+def hashtag_rows(record: dict):
+    """tiktok_post_hashtags rows of a promo expense record."""
+    post = parse_post(record)
+    if not post or json_value(post.get("id")) is None:
+        return []
+    return [
+        {
+            "post_id": json_value(post.get("id")),
+            "hashtag_index": i,
+            "hashtag_id": json_value(h.get("id")) if isinstance(h, dict) else None,
+            "hashtag_name": json_value(h.get("name")) if isinstance(h, dict) else None,
+        }
+        for i, h in enumerate(post.get("hashtags") or [])
+    ]
+
+
+class PostLoader:
+    """
+    Incremental load of the posts carried by promo expense records: a post is
+    written only if it is new or its payload hash changed since the last load.
+    Rows are spooled to local files while pages come in; load() writes them,
+    the rows of the last record of each post only, and deletes the posts no
+    live promo expense points to any more.
+    """
+
+    def __init__(self, client: bigquery.Client, project_id: str, dlq):
+        self.client = client
+        self.project_id = project_id
+        self.dlq = dlq
+        self.tables = table_ids()
+        self.refs = {}
+        for name, schema in (("posts", POSTS_SCHEMA), ("hashtags", HASHTAGS_SCHEMA)):
+            dataset_id, table_id = self.tables[name]
+            table = bigquery.Table(client.dataset(dataset_id).table(table_id), schema=schema)
+            self.refs[name] = client.create_table(table, exists_ok=True).reference
+        # a record that fails to map is quarantined under its post id
+        dlq.keys[dead_letter.table_name(self.refs["posts"])] = ("post_id", post_id)
+        dlq.keys[dead_letter.table_name(self.refs["hashtags"])] = (("post_id", "hashtag_index"), post_id)
+
+        dataset_id, table_id = self.tables["posts"]
+        sql = f"SELECT post_id, json_hash FROM `{project_id}.{dataset_id}.{table_id}`"
+        self.known = {r.post_id: r.json_hash for r in client.query(sql).result()}
+        # an empty table is replaced with one load job instead of a keyed replace
+        self.first_load = not self.known
+        self._reset()
+
+    def _reset(self):
+        self.files = {name: tempfile.NamedTemporaryFile("w+b", suffix=".ndjson") for name in self.tables}
+        self.counts = {name: 0 for name in self.tables}
+        self.changed = []
+        self.spooled = 0  # records spooled
+        self.latest = {}  # post_id -> number of the last record spooled for it
+        self.sources = {name: [] for name in self.tables}  # record number of each spooled row
+
+    def add(self, records):
+        """Spool the posts of a page of promo expense records that changed."""
+        for record in records:
+            if to_bool(record.get("deleted")):
+                continue  # its post goes with load(deleted=...) unless another expense points to it
+            try:
+                post = parse_post(record)
+            except ValueError:
+                post = {}  # unparseable: post_rows raises again and the record is quarantined
+            if post is None:
+                continue
+            # unchanged since the last load, or already seen in this run:
+            # several promo expenses can point to the same post. One with a
+            # different payload is spooled again and supersedes the first
+            if post and self.known.get(json_value(post.get("id"))) == post_hash(post):
+                continue
+
+            rows = self.dlq.map(self.refs["posts"], post_rows, [record])
+            self.dlq.count(len(rows))
+            # a row the load would reject is quarantined instead of failing the load
+            rows = self.dlq.validate(self.refs["posts"], POSTS_SCHEMA, rows, post_rows, lambda row: record)
+            if not rows:
+                continue
+            row = rows[0]
+            self.known[row["post_id"]] = row["json_hash"]
+            self.changed.append(row["post_id"])
+            self.latest[row["post_id"]] = self.spooled
+            self._spool("posts", rows)
+            hashtags = self.dlq.map(self.refs["hashtags"], hashtag_rows, [record])
+            self.dlq.count(len(hashtags))
+            hashtags = self.dlq.validate(
+                self.refs["hashtags"], HASHTAGS_SCHEMA, hashtags, hashtag_rows, lambda row: record
+            )
+            self._spool("hashtags", hashtags)
+            self.spooled += 1
+
+    def _spool(self, name: str, rows):
+        for row in rows:
+            self.files[name].write(json.dumps(row).encode("utf-8") + b"\n")
+        self.counts[name] += len(rows)
+        self.sources[name].extend([self.spooled] * len(rows))
+
+    def _drop_superseded(self, name: str):
+        """Rewrite a spool file without the rows of posts spooled again by a later record."""
+        f = self.files[name]
+        f.seek(0)
+        kept = tempfile.NamedTemporaryFile("w+b", suffix=".ndjson")
+        count = 0
+        for line, source in zip(f, self.sources[name]):
+            if self.latest[json.loads(line)["post_id"]] == source:
+                kept.write(line)
+                count += 1
+        f.close()
+        self.files[name] = kept
+        self.counts[name] = count
+
+    def load(self, deleted=()):
+        """
+        Write the spooled posts and hashtags, replacing earlier rows of the
+        same posts, and delete the posts in deleted with their hashtags.
+        """
+        deleted = set(deleted) - set(self.latest)
+        for name, (dataset_id, table_id) in self.tables.items():
+            if len(self.latest) < self.spooled:
+                self._drop_superseded(name)
+            f = self.files[name]
+            if self.first_load:
+                job_config = bigquery.LoadJobConfig(
+                    schema=POSTS_SCHEMA if name == "posts" else HASHTAGS_SCHEMA,
+                    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                )
+                f.seek(0)
+                self.client.load_table_from_file(f, self.refs[name], job_config=job_config).result()
+            else:
+                bq_upsert.replace_by_key_from_file(
+                    self.client, self.project_id, dataset_id, table_id,
+                    "post_id", set(self.changed) | deleted, f, self.counts[name],
+                )
+            f.close()
+            print(f"Loaded {self.counts[name]} changed rows into {self.project_id}.{dataset_id}.{table_id}")
+        if deleted and not self.first_load:
+            for post in deleted:
+                self.known.pop(post, None)
+            print(f"Deleted {len(deleted)} posts no promo expense points to any more")
+        self.first_load = False
+        self._reset()
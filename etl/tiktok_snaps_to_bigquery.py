@@ -1,11 +1,16 @@
 import os
 import json
-import requests
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+import dead_letter
+import full_load
+import rate_limiter
+import run_state
+
 BASE_URL = "https://tamerlan-0to8-0to8-music-recognition-a469.twc1.net/api/admin/snapshots"
 LIMIT = 500
+JOB_NAME = "tiktok_snaps"
 
 
 def get_bq_client() -> bigquery.Client:
@@ -25,7 +30,7 @@ def fetch_page(api_key: str, offset: int):
         "X-Admin-Api-Key": api_key,
         "Content-Type": "application/json",
     }
-    resp = requests.get(BASE_URL, params=params, headers=headers, timeout=60)
+    resp = rate_limiter.get(BASE_URL, params=params, headers=headers, timeout=60)
     print("DEBUG status:", resp.status_code, "offset:", offset)
     print("DEBUG body:", resp.text[:300])
     resp.raise_for_status()
@@ -34,25 +39,26 @@ def fetch_page(api_key: str, offset: int):
     return data.get("data", [])
 
 
+def to_bq_row(x):
+    return {
+        "id": x["id"],
+        "promo_expense_id": x.get("promo_expense_id"),
+        "views": x.get("views"),
+        "likes": x.get("likes"),
+        "comments": x.get("comments"),
+        "shares": x.get("shares"),
+        "snapshot_date": x.get("snapshot_date"),
+        "created_at": x.get("created_at"),
+    }
+
+
 def to_bq_rows(items):
-    rows = []
-    for x in items:
-        rows.append(
-            {
-                "id": x["id"],
-                "promo_expense_id": x.get("promo_expense_id"),
-                "views": x.get("views"),
-                "likes": x.get("likes"),
-                "comments": x.get("comments"),
-                "shares": x.get("shares"),
-                "snapshot_date": x.get("snapshot_date"),
-                "created_at": x.get("created_at"),
-            }
-        )
-    return rows
+    return [to_bq_row(x) for x in items]
 
 
 def main():
+    if run_state.push_fed(JOB_NAME):
+        return
     project_id = os.environ["GCP_PROJECT_ID"]
     dataset_id = os.environ.get("BQ_SNAPS_DATASET_ID", "raw_tiktok")
     table_id = os.environ.get("BQ_SNAPS_TABLE_ID", "tiktok_snaps")
@@ -61,31 +67,37 @@ def main():
     client = get_bq_client()
     table_ref = client.dataset(dataset_id).table(table_id)
 
-    # *** Overwrite: clear table before inserting this run ***
-    truncate_sql = f"TRUNCATE TABLE `{project_id}.{dataset_id}.{table_id}`"
-    print(f"Running: {truncate_sql}")
-    client.query(truncate_sql).result()
-    print("Table truncated before load")
+    run = run_state.begin(JOB_NAME)
+    dlq = dead_letter.DeadLetter(
+        JOB_NAME, client, project_id, run, keys={dead_letter.table_name(table_ref): ("id", "id")}
+    )
+    # *** Overwrite: the run fills a staging table, published over the table at the end ***
+    staging_ref = full_load.staging_table(client, run, table_ref)
 
-    offset = 0
-    total_rows = 0
+    offset = run["offset"]
+    total_rows = run["rows"]
 
     while True:
         items = fetch_page(api_key, offset)
         if not items:
             break
 
-        rows = to_bq_rows(items)
-        errors = client.insert_rows_json(table_ref, rows)
-        if errors:
-            raise RuntimeError(f"BigQuery insert errors: {errors}")
+        rows = dlq.map(table_ref, to_bq_row, items)
+        inserted = dlq.insert(table_ref, rows, to_bq_row, dead_letter.by_key(lambda: items, "id"), into=staging_ref)
 
-        batch_count = len(rows)
+        batch_count = len(inserted)
         total_rows += batch_count
         print(f"Inserted batch at offset={offset}, rows={batch_count}")
         offset += LIMIT
 
+        if run_state.page_done(JOB_NAME, run, offset, items, batch_count):
+            dlq.flush()
+            return
+
     print(f"Inserted total {total_rows} rows into {project_id}.{dataset_id}.{table_id}")
+    dlq.finish()
+    full_load.publish(client, project_id, table_ref, staging_ref)
+    run_state.finish(JOB_NAME, run)
 
 
 if __name__ == "__main__":